@@ -1,7 +1,16 @@
 import streamlit as st
-import matplotlib.pyplot as plt
-import pandas as pd
+import os
+import sys
+import hashlib
+import time
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import utils
+import game_store
+import fetch_scheduler
+import metrics
+import snapshots
 
 st.title('GeoInsight')
 st.write('''
@@ -13,70 +22,326 @@ st.divider()
 
 ncfa_guide_url = 'https://github.com/SafwanSipai/geo-insight?tab=readme-ov-file#getting-your-_ncfa-cookie'
 
+# bounds for the per-session memo of feeds, stats and figures
+MEMO_TTL_SEC = 30 * 60
+MEMO_MAX_ENTRIES = 32
+# estimated size of one session's memo, the least recently used entries are dropped beyond it
+MEMO_MAX_MB = float(os.environ.get('GEOINSIGHT_SESSION_MEMO_MB', 100))
+# longest an analysis may run in seconds, 0 for no limit. Keeps the load on GeoGuessr and this server predictable
+MAX_ANALYSIS_SEC = int(os.environ.get('GEOINSIGHT_MAX_ANALYSIS_SEC', 0))
+
+@st.cache_resource
+def get_game_store():
+    return game_store.GameStore()
+
+@st.cache_resource
+def get_fetch_scheduler():
+    # every session's feed and game requests share one rate budget and worker pool
+    return fetch_scheduler.FetchScheduler()
+
+@st.cache_resource
+def get_figure_pool():
+    # figures are drawn in their own processes, spawned rather than forked from this multi-threaded one
+    pool = ProcessPoolExecutor(utils.FIGURE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    for _ in range(utils.FIGURE_WORKERS):
+        pool.submit(utils.warm_up_figure_worker)
+    return pool
+
+def get_size(value):
+    # rough number of bytes a memoized value holds on to
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if hasattr(value, 'memory_usage'):
+        # pandas, a DataFrame's usage is per column
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(get_size(k) + get_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(get_size(item) for item in value)
+    return sys.getsizeof(value)
+
+def get_memo():
+    # st.session_state survives the rerun of this script on every widget interaction.
+    # Entries are (created, value, size in bytes)
+    memo = st.session_state.setdefault('memo', {})
+    now = time.time()
+    for expired_key in [k for k, (created, _, _) in memo.items() if now - created > MEMO_TTL_SEC]:
+        del memo[expired_key]
+    return memo
+
+def get_memo_size(memo):
+    # a stopped analysis is kept next to the memo and counts towards the same cap
+    _, _, stopped_size = st.session_state.get('stopped_analysis', (None, None, 0))
+    return sum(size for _, _, size in memo.values()) + stopped_size
+
+def memo_get(key):
+    memo = get_memo()
+    if key not in memo:
+        return None
+    memo[key] = memo.pop(key)
+    return memo[key][1]
+
+def memo_set(key, value):
+    memo = get_memo()
+    memo.pop(key, None)
+    size = get_size(value)
+    if size > MEMO_MAX_MB * 1e6:
+        # computed again when needed rather than pushing out everything else
+        metrics.increment('memo_too_large')
+        return value
+    memo[key] = (time.time(), value, size)
+    while len(memo) > MEMO_MAX_ENTRIES or get_memo_size(memo) > MEMO_MAX_MB * 1e6:
+        del memo[next(iter(memo))]
+        metrics.increment('memo_evictions')
+    return value
+
+def keep_stopped_analysis(key, stats):
+    # only one stopped analysis is kept, until Analyze is clicked again
+    st.session_state.stopped_analysis = (key, stats, get_size(stats))
+    memo = get_memo()
+    while memo and get_memo_size(memo) > MEMO_MAX_MB * 1e6:
+        del memo[next(iter(memo))]
+        metrics.increment('memo_evictions')
+
+def memoize(key, compute):
+    value = memo_get(key)
+    return value if value is not None else memo_set(key, compute())
+
+def get_tables(stats):
+    # Extracting most and least stats for points and distances per country
+    most_pts, least_pts = utils.get_most_and_least_data(stats, type='points')
+    most_dist, least_dist = utils.get_most_and_least_data(stats, type='distance')
+    return most_pts, least_pts, most_dist, least_dist, utils.get_confusion_table(stats), utils.get_offset_table(stats)
+
+def format_count(stats, key):
+    # estimated for all games when the stats are of a sample
+    return f"~{stats['estimated_' + key]}" if 'estimated_' + key in stats else str(stats[key])
+
+def format_average(stats, key, unit=''):
+    # with the margin of its 95% confidence interval when the stats are of a sample
+    interval = stats.get('confidence_intervals', {}).get(key)
+    return (str(stats[key]) if interval is None else f'{stats[key]} ± {(interval[1] - interval[0]) // 2}') + unit
+
+def plot_and_display_data(stats, placeholder, mode, stats_key, partial=False, earlier_stats=None):
+    if not stats['number_of_games']:
+        placeholder.info('No games in this mode.')
+        return
+    if partial:
+        most_pts, least_pts, most_dist, least_dist, confusions, offsets = get_tables(stats)
+    else:
+        most_pts, least_pts, most_dist, least_dist, confusions, offsets = memoize(('tables', stats_key, mode), lambda: get_tables(stats))
+
+    # changes since the saved analysis picked for comparison, if any
+    delta = snapshots.diff_stats(stats, earlier_stats) if earlier_stats else {}
+
+    # Displaying data and figures in the corresponding tab, replacing what was shown before
+    with placeholder.container():
+        col1, col2, col3 = st.columns(3)
+        col1.metric('Total Games', format_count(stats, 'number_of_games'), delta.get('number_of_games'))
+        col2.metric('Total Rounds', format_count(stats, 'number_of_rounds'), delta.get('number_of_rounds'))
+        col3.metric('Average Offset', utils.format_offset(*stats['average_offset']),
+                    help='How far north or south and east or west of the location your guesses are on average')
+
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric('Average Points', format_average(stats, 'average_score'), delta.get('average_score'))
+        col2.metric('Average Distance', format_average(stats, 'average_distance', ' KM'), delta.get('average_distance'),
+                    delta_color='inverse')
+        col3.metric('Average Game Time', format_average(stats, 'average_time', ' seconds'), delta.get('average_time'),
+                    delta_color='off')
+        col4.metric('Correct Country', f"{stats['correct_country_rate']:.0%}",
+                    f"{delta['correct_country_rate']:+.0%}" if delta else None,
+                    help='Rounds where the guess was in the right country')
+
+        st.write('Points lost per country - Least vs Most')
+        col1, col2 = st.columns(2)
+        col1.dataframe(least_pts[::-1], hide_index=True)
+        col2.dataframe(most_pts, hide_index=True)
+
+        st.write('Distance per country - Least vs Most')
+        col1, col2 = st.columns(2)
+        col1.dataframe(least_dist[::-1], hide_index=True)
+        col2.dataframe(most_dist, hide_index=True)
+
+        st.write('Most confused countries')
+        st.dataframe(confusions, hide_index=True)
+
+        st.write('Countries guessed furthest off in one direction')
+        st.dataframe(offsets, hide_index=True)
+
+        if not partial:
+            images = memoize(('figures', stats_key, mode), lambda: utils.render_figures(stats, get_figure_pool()))
+            for image in images:
+                with metrics.timer('display_figure'):
+                    st.image(image, width='stretch')
+
+def make_mode_placeholders(analyzing=False):
+    st.header('Singleplayer Games')
+    # only the open tab is filled in, switching tabs reruns the script to draw the other one. That rerun
+    # would interrupt a running analysis, so while one runs the tabs switch in the browser only and all
+    # of them are filled in (their open is None then)
+    tabs = st.tabs(['Moving', 'No moving', 'NMPZ'], key='mode_tab', on_change='ignore' if analyzing else 'rerun')
+    return {mode: tab.empty() for mode, tab in zip(utils.MODES, tabs) if tab.open is not False}
+
+def read_uploaded_snapshot(uploaded_file):
+    data = uploaded_file.getvalue()
+    try:
+        return memoize(('snapshot', hashlib.sha256(data).hexdigest()), lambda: snapshots.read_snapshot(io.BytesIO(data)))
+    except ValueError as e:
+        st.error(f'{uploaded_file.name} could not be read as a saved analysis ({e}).')
+        st.stop()
+
+def show_sample(stats):
+    if stats['sample']:
+        st.info(f"Estimated from {stats['sample']['sampled_games']} games picked at random across "
+                f"{stats['sample']['population_games']}. Averages show the margin of their 95% confidence interval, "
+                f"totals and rounds per country and the counts in the bar, histogram and compass charts are scaled up to all "
+                f"{stats['sample']['population_games']} games. The points vs time chart and the map show the sampled rounds.")
+
+def show_dropped_games(stats):
+    if stats['dropped_games']:
+        reasons = ', '.join(f'{count} {reason.replace("_", " ")}' for reason, count in stats['dropped_games'].items())
+        st.warning(f'{sum(stats["dropped_games"].values())} games could not be analyzed ({reasons}) and are not included below.')
+
+def stop_analysis():
+    # on_click of the Stop button. It runs at the start of the rerun the click causes, by when the running
+    # analysis has usually been interrupted already and kept its partial result, cancelling its budget
+    # makes sure it stops either way
+    running = st.session_state.get('running_analysis')
+    if running:
+        running['budget'].cancel()
+
 ncfa = st.text_input('Enter your NCFA cookie ([click here to obtain yours](%s))' % ncfa_guide_url, None)
-if ncfa:
-    with st.spinner(text='Fetching data...'):
-        session = utils.get_session(ncfa)
-        game_tokens = utils.get_game_tokens(session)
-
-    default_number_of_games = 100 if len(game_tokens) > 100 else len(game_tokens)
-    st.slider('How many games would you like to analyze? (400 games ~ 1 min analysis time)', 0, len(game_tokens), default_number_of_games,
-              step=10, key='slider', 
-              help='''Adjusting the slider value determines the number of your most recent games to analyze. 
-                      For instance, selecting '50' will analyze your fifty most recent games. 
-                      Please note that higher values will increase processing time accordingly.''')
+use_cache = st.checkbox('Cache finished games locally', value=game_store.CACHE_ENABLED, disabled=not game_store.CACHE_ENABLED,
+                        help='''Finished games never change, so keeping a copy makes re-analyzing them instant.
+                                Untick this to keep all game data in memory only.''')
+with st.expander('Saved analyses'):
+    snapshot_file = st.file_uploader('Open a saved analysis instead of fetching your games', type=['parquet'])
+    earlier_file = st.file_uploader('Compare with an earlier saved analysis', type=['parquet'])
+# per-run timings and counters, shown in the sidebar with ?debug=1 or GEOINSIGHT_DEBUG=1
+recorder = metrics.Metrics()
+show_debug_panel = st.query_params.get('debug') == '1' or os.environ.get('GEOINSIGHT_DEBUG') == '1'
+
+with metrics.recording(recorder):
+    earlier_stats = read_uploaded_snapshot(earlier_file)[0] if earlier_file else None
+    if ncfa:
+        account_key = utils.get_account_key(ncfa)
+        store = get_game_store() if use_cache else None
+        # started now so that the workers are ready by the time the games are fetched
+        get_figure_pool()
+        with st.spinner(text='Fetching data...'):
+            session = memoize(('session', account_key), lambda: utils.get_session(ncfa, scheduler=get_fetch_scheduler()))
+            try:
+                game_tokens = memoize(('game_tokens', account_key, use_cache),
+                                      lambda: utils.sync_game_tokens(session, account_key, game_store=store,
+                                                                      scheduler=get_fetch_scheduler()))
+            except Exception as e:
+                st.error(f'Could not load your games ({utils.get_drop_reason(e)}), please check your NCFA cookie and try again.')
+                st.stop()
+
+        default_number_of_games = 100 if len(game_tokens) > 100 else len(game_tokens)
+        st.slider('How many games would you like to analyze?', 0, len(game_tokens), default_number_of_games,
+                  step=10, key='slider', 
+                  help='''Adjusting the slider value determines the number of your most recent games to analyze. 
+                          For instance, selecting '50' will analyze your fifty most recent games. 
+                          Please note that higher values will increase processing time accordingly.''')
+        time_limit = st.number_input('Time limit in seconds', 0, MAX_ANALYSIS_SEC or None, MAX_ANALYSIS_SEC, step=10,
+                                     help='''The analysis stops after this many seconds and shows the games analyzed by then.
+                                             0 means no limit''' + (f' (at most {MAX_ANALYSIS_SEC} seconds on this server).' if MAX_ANALYSIS_SEC else '.'))
+        estimate = st.checkbox(f'Quick estimate from {utils.SAMPLE_SIZE} games',
+                               help=f'''Analyzes {utils.SAMPLE_SIZE} games picked at random across the selected ones, spread evenly over time,
+                                        and estimates the results of all of them. Much faster for many games.''')
+        sample_size = utils.SAMPLE_SIZE if estimate else None
     
-    button = st.button('Analyze')
+        button = st.button('Analyze')
     
-    if button:
-        progress_bar = st.progress(0)
-        stats = utils.get_stats(session, game_tokens, st.session_state.slider, progress_bar)
-        mov_stats = stats['moving']
-        no_mov_stats = stats['no-moving']
-        nmpz_stats = stats['nmpz']
-        
-        def plot_and_display_data(stats, label):
-            # Extracting most and least stats for points and distances per country
-            most_pts, least_pts = utils.get_most_and_least_data(stats, type='points')
-            most_dist, least_dist = utils.get_most_and_least_data(stats, type='distance')
-
-            # Plotting figures
-            points_vs_time_fig = utils.plot_points_vs_time(stats)
-            points_hist_fig = utils.points_histogram(stats)
-            countries_bar_fig = utils.plot_countries_bar_chart(stats)
-            guessed_loc_fig = utils.plot_guessed_locations(stats['guessed_locations'])
-
-            # Displaying data and figures in the corresponding tab
-            with label:
-                col1, col2 = st.columns(2)
-                col1.metric('Total Games', str(stats['number_of_games']))
-                col2.metric('Total Rounds', str(stats['number_of_rounds']))
-
-                col1, col2, col3 = st.columns(3)
-                col1.metric('Average Points', str(stats['average_score']))
-                col2.metric('Average Distance', str(stats['average_distance']) + ' KM')
-                col3.metric('Average Game Time', str(stats['average_time']) + ' seconds')
-
-                st.write('Points lost per country - Least vs Most')
-                col1, col2 = st.columns(2)
-                col1.dataframe(least_pts[::-1], hide_index=True)
-                col2.dataframe(most_pts, hide_index=True)
-
-                st.write('Distance per country - Least vs Most')
-                col1, col2 = st.columns(2)
-                col1.dataframe(least_dist[::-1], hide_index=True)
-                col2.dataframe(most_dist, hide_index=True)
-
-                st.pyplot(countries_bar_fig)
-                st.pyplot(points_vs_time_fig)
-                st.pyplot(points_hist_fig)
-                st.pyplot(guessed_loc_fig)
-
-        progress_bar.empty()
-        
-        st.header('Singleplayer Games')
-        mov, no_mov, nmpz = st.tabs(['Moving', 'No moving', 'NMPZ'])
+        number_of_games = st.session_state.slider
+        tokens_hash = hashlib.sha256(' '.join(game_tokens[:number_of_games]).encode()).hexdigest()
+        stats_key = ('stats', account_key, tokens_hash, number_of_games, time_limit, sample_size)
+        if button:
+            st.session_state.analyzed_key = stats_key
+            st.session_state.pop('stopped_analysis', None)
+    
+        # results stay on screen across reruns until the slider selects a different set of games
+        if st.session_state.get('analyzed_key') == stats_key:
+            progress_bar = st.progress(0)
         
-        plot_and_display_data(mov_stats, mov)
-        plot_and_display_data(no_mov_stats, no_mov)
-        plot_and_display_data(nmpz_stats, nmpz)
\ No newline at end of file
+            # only complete analyses are memoized, one that was stopped is kept until Analyze is clicked again
+            stats = memo_get(stats_key)
+            stopped_key, stopped_stats, _ = st.session_state.get('stopped_analysis', (None, None, 0))
+            analyzing = stats is None and stopped_key != stats_key
+            placeholders = make_mode_placeholders(analyzing)
+            if stats is None and stopped_key == stats_key:
+                stats = stopped_stats
+            elif analyzing:
+                # the budget also lets a rerun (e.g. a slider change) stop this analysis within utils.BUDGET_POLL_SEC
+                budget = utils.AnalysisBudget(time_limit or MAX_ANALYSIS_SEC or None)
+                st.session_state.running_analysis = {'budget': budget}
+                stop_placeholder = st.empty()
+                stop_placeholder.button('Stop', on_click=stop_analysis,
+                                        help='Stops the analysis and shows the games analyzed so far.')
+                # partial numbers are shown every utils.STREAM_BATCH_SIZE games, the charts are drawn once at the end.
+                # A rerun (the Stop button, a slider change) interrupts the loop, its latest partial result is kept then
+                finished = False
+                try:
+                    for stats in utils.iter_stats(session, game_tokens, number_of_games, progress_bar, game_store=store,
+                                                     scheduler=get_fetch_scheduler(), budget=budget, sample_size=sample_size):
+                        for mode in placeholders:
+                            plot_and_display_data(stats[mode], placeholders[mode], mode, stats_key, partial=True)
+                    finished = True
+                finally:
+                    st.session_state.pop('running_analysis', None)
+                    if not finished:
+                        keep_stopped_analysis(stats_key, stats and dict(stats, stop_reason='cancelled'))
+                stop_placeholder.empty()
+                if stats['stop_reason']:
+                    keep_stopped_analysis(stats_key, stats)
+                else:
+                    memo_set(stats_key, stats)
+            progress_bar.empty()
+
+            if stats is None:
+                st.info('The analysis was stopped before any games were analyzed. Click Analyze to start it again.')
+            else:
+                if stats['stop_reason']:
+                    analyzed = sum(stats[mode]['number_of_games'] for mode in utils.MODES)
+                    planned = min(sample_size, number_of_games) if sample_size else number_of_games
+                    reason = 'The time limit was reached' if stats['stop_reason'] == 'time_budget' else 'The analysis was stopped'
+                    st.info(f'{reason} after {analyzed} of {planned} games, the results below cover those. '
+                            'Click Analyze to continue, games fetched already are not requested again if they are cached.')
+                    # tables and figures of stopped results are not mixed up with those of the complete analysis
+                    stats_key = stats_key + (stats['stop_reason'], analyzed)
+                show_sample(stats)
+                show_dropped_games(stats)
+                # the partial results of utils.iter_stats, which the Stop button keeps the last of, have no round table to save
+                if stats[utils.MODES[0]]['rounds'] is not None:
+                    st.download_button('Save this analysis', memoize(('snapshot_bytes', stats_key), lambda: snapshots.get_snapshot_bytes(stats)),
+                                       file_name=f'geo-insight-{time.strftime("%Y-%m-%d")}.parquet',
+                                       help='Open the file here later to see this analysis again without fetching, or to compare a new one with it.')
+
+                for mode in placeholders:
+                    plot_and_display_data(stats[mode], placeholders[mode], mode, stats_key,
+                                          earlier_stats=earlier_stats[mode] if earlier_stats else None)
+    elif snapshot_file:
+        stats, snapshot_metadata = read_uploaded_snapshot(snapshot_file)
+        stats_key = ('saved_stats', hashlib.sha256(snapshot_file.getvalue()).hexdigest())
+        st.caption(f'Saved analysis from {snapshot_metadata["created_at"]}')
+        placeholders = make_mode_placeholders()
+        show_sample(stats)
+        show_dropped_games(stats)
+        for mode in placeholders:
+            plot_and_display_data(stats[mode], placeholders[mode], mode, stats_key,
+                                  earlier_stats=earlier_stats[mode] if earlier_stats else None)
+
+if show_debug_panel:
+    import pandas as pd
+    snapshot = recorder.snapshot()
+    with st.sidebar:
+        st.subheader('Debug metrics')
+        st.caption('Timings of this run, cached results are not re-measured.')
+        st.dataframe(pd.DataFrame.from_dict(snapshot['timings'], orient='index').rename_axis('phase'))
+        st.dataframe(pd.Series(snapshot['counters'], name='value', dtype='int64').rename_axis('counter'))
+        memo = get_memo()
+        st.caption(f'Memo of this session: {len(memo)} entries, {get_memo_size(memo) / 1e6:.1f} of {MEMO_MAX_MB:g} MB.')
@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+import game_store
+import fetch_scheduler
+import metrics
+
+# analyzes many accounts without the web app, e.g.
+#   python batch.py --cookies cookies.txt --out reports
+# cookies.txt holds one _ncfa cookie per line. The results of each account go to <out>/<account id>/,
+# the account id is the start of a hash of the cookie, so cookies are never written to disk
+
+# accounts analyzed at the same time, their requests share one fetch_scheduler.FetchScheduler
+BATCH_WORKERS = 4
+ROUNDS_FORMATS = ['json', 'parquet']
+
+class NullProgress:
+    def progress(self, *args):
+        pass
+
+def read_cookies(path):
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    cookies = [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+    # the same account listed twice is analyzed once
+    return list(dict.fromkeys(cookies))
+
+def get_account_dir(out_dir, account_key):
+    return os.path.join(out_dir, account_key[:16])
+
+def write_atomically(path, write):
+    # a crash never leaves a half-written file behind under the final name
+    write(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def write_json(path, data):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            # numpy scalars are written as plain numbers
+            json.dump(data, f, indent=2, default=lambda value: value.item())
+    write_atomically(path, write)
+
+def stats_to_json(stats):
+    # the per-round data is in the round table, the rest of get_stats' result is kept as is
+    result = {'dropped_games': stats['dropped_games'], 'sample': stats['sample']}
+    for mode in utils.MODES:
+        mode_stats = {key: value for key, value in stats[mode].items() if key not in ('rounds', 'guessed_locations')}
+        mode_stats['round_wise_points'] = mode_stats['round_wise_points'].tolist()
+        mode_stats['round_wise_time'] = mode_stats['round_wise_time'].tolist()
+        result[mode] = mode_stats
+    return result
+
+def write_round_table(path, round_table, rounds_format):
+    if rounds_format == 'parquet':
+        write_atomically(path, round_table.to_parquet)
+    else:
+        write_atomically(path, lambda tmp_path: round_table.to_json(tmp_path, orient='records', lines=True))
+
+def count_tokens(token_pages, page_sizes):
+    # passes token_pages on, appending the number of tokens of each page to page_sizes
+    for page_tokens in token_pages:
+        page_sizes.append(len(page_tokens))
+        yield page_tokens
+
+def analyze_account(ncfa, out_dir, number_of_games=None, rounds_format='json', store=None, scheduler=None,
+                    force=False, time_budget_sec=None, sample_size=None):
+    # returns (account directory, number of games analyzed or None when it was already done, stop reason).
+    # checkpoint.json is written last, an account that has one is skipped unless force is set.
+    # Finished games are kept in the game store as they arrive, so an account that was
+    # interrupted, or stopped by its time budget, only fetches the games it is still missing
+    import pandas as pd
+    account_key = utils.get_account_key(ncfa)
+    account_dir = get_account_dir(out_dir, account_key)
+    checkpoint_path = os.path.join(account_dir, 'checkpoint.json')
+    if os.path.exists(checkpoint_path) and not force:
+        return account_dir, None, None
+    os.makedirs(account_dir, exist_ok=True)
+
+    recorder = metrics.Metrics()
+    with metrics.recording(recorder):
+        session = utils.get_session(ncfa, scheduler=scheduler)
+        page_sizes = None
+        if number_of_games is None:
+            game_tokens = utils.sync_game_tokens(session, account_key, game_store=store, scheduler=scheduler)
+            number_of_games = len(game_tokens)
+        else:
+            # only the most recent games are needed, those of each feed page are requested while the next one loads
+            page_sizes = []
+            game_tokens = count_tokens(utils.iter_game_tokens(session, scheduler=scheduler), page_sizes)
+        stats = utils.get_stats(session, game_tokens, number_of_games, NullProgress(), game_store=store,
+                                scheduler=scheduler, budget=utils.AnalysisBudget(time_budget_sec), sample_size=sample_size)
+        if stats['sample']:
+            # the games the estimate is from, the number it was drawn from is in stats['sample']
+            number_of_games = stats['sample']['sampled_games']
+        elif page_sizes is not None:
+            # fewer when the feed ran out first
+            number_of_games = min(number_of_games, sum(page_sizes))
+
+    round_table = pd.concat([stats[mode]['rounds'] for mode in utils.MODES], ignore_index=True)
+    write_round_table(os.path.join(account_dir, f'rounds.{rounds_format}'), round_table, rounds_format)
+    write_json(os.path.join(account_dir, 'stats.json'), stats_to_json(stats))
+    write_json(os.path.join(account_dir, 'metrics.json'), recorder.snapshot())
+    if stats['stop_reason'] is not None:
+        # the results so far are written, the next run picks up where this one stopped
+        return account_dir, sum(stats[mode]['number_of_games'] for mode in utils.MODES), stats['stop_reason']
+    write_json(checkpoint_path, {'number_of_games': number_of_games,
+                                 'dropped_games': stats['dropped_games'],
+                                 'sample': stats['sample'],
+                                 'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')})
+    return account_dir, number_of_games, None
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze the GeoGuessr games of many accounts.')
+    parser.add_argument('--cookies', required=True, help='file with one _ncfa cookie per line, - for stdin')
+    parser.add_argument('--out', required=True, help='folder the results are written to')
+    parser.add_argument('--games', type=int, default=None, help='most recent games per account, all by default')
+    parser.add_argument('--rounds-format', choices=ROUNDS_FORMATS, default='json', help='format of the round tables')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='accounts analyzed at the same time')
+    parser.add_argument('--no-cache', action='store_true', help='do not keep finished games in the game cache')
+    parser.add_argument('--force', action='store_true', help='analyze accounts that already have a checkpoint again')
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help='seconds per account, an account that runs out is continued by the next run')
+    parser.add_argument('--sample', type=int, default=None, metavar='GAMES',
+                        help='estimate the results from this many games picked at random across time')
+    args = parser.parse_args()
+
+    cookies = read_cookies(args.cookies)
+    store = game_store.GameStore() if game_store.CACHE_ENABLED and not args.no_cache else None
+    scheduler = fetch_scheduler.FetchScheduler()
+
+    def run(ncfa):
+        try:
+            return analyze_account(ncfa, args.out, args.games, args.rounds_format, store, scheduler, args.force,
+                                   args.time_budget, args.sample), None
+        except Exception as e:
+            return (get_account_dir(args.out, utils.get_account_key(ncfa)), None, None), e
+
+    unfinished = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for (account_dir, number_of_games, stop_reason), error in executor.map(run, cookies):
+            if error is not None:
+                unfinished += 1
+                print(f'{account_dir}: failed ({utils.get_drop_reason(error)}: {error})')
+            elif stop_reason is not None:
+                unfinished += 1
+                print(f'{account_dir}: stopped by the {stop_reason.replace("_", " ")} after {number_of_games} games')
+            elif number_of_games is None:
+                print(f'{account_dir}: already done, skipped')
+            else:
+                print(f'{account_dir}: {number_of_games} games')
+    print(f'{len(cookies) - unfinished} of {len(cookies)} accounts done')
+    sys.exit(1 if unfinished else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# checks that the modules app.py imports at startup stay cheap, run it from the root folder with
+#   python -m benchmarks.import_budget
+# it exits with status 1 when a heavy dependency is imported eagerly again or the budget is exceeded
+
+STARTUP_MODULES = ['utils', 'game_store', 'metrics', 'fetch_scheduler', 'snapshots']
+HEAVY_MODULES = ['pandas', 'numpy', 'matplotlib', 'geopandas', 'shapely']
+IMPORT_BUDGET_SEC = 0.5
+
+# run in a fresh interpreter so that nothing is imported already
+MEASURE_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def measure(modules, heavy_modules):
+    script = MEASURE_SCRIPT.format(modules=modules, heavy=heavy_modules)
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the modules GeoInsight starts with.')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_SEC, help='allowed seconds, median of the runs')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [measure(STARTUP_MODULES, HEAVY_MODULES) for _ in range(args.runs)]
+    seconds = statistics.median(result['seconds'] for result in results)
+    heavy = sorted({module for result in results for module in result['heavy']})
+    print(f'importing {", ".join(STARTUP_MODULES)} took {seconds:.3f}s (budget {args.budget:.3f}s)')
+
+    failed = False
+    if heavy:
+        print(f'FAIL: imported at startup: {", ".join(heavy)}')
+        failed = True
+    if seconds > args.budget:
+        print('FAIL: over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
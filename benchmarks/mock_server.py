@@ -0,0 +1,127 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from benchmarks import synthetic_data
+
+# local stand-in for the two GeoGuessr endpoints GeoInsight uses, run it with
+#   python -m benchmarks.mock_server --games 1000 --latency 0.05
+# and point the app at it with GEOINSIGHT_API_URL=http://127.0.0.1:8000/api
+
+class MockGeoGuessr:
+    def __init__(self, number_of_games, page_size=10, latency=0.0, jitter=0.0, rate_limit=None, seed=0):
+        self.game_tokens = synthetic_data.make_game_tokens(number_of_games, seed)
+        self.feed_pages = synthetic_data.make_feed_pages(self.game_tokens, page_size, seed)
+        self.known_tokens = set(self.game_tokens)
+        self.seed = seed
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.allowance = rate_limit or 0
+        self.last_refill = time.monotonic()
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.counters = {'feed_requests': 0, 'game_requests': 0, 'throttled': 0, 'bytes_sent': 0}
+
+    def throttle(self):
+        # token bucket holding up to one second worth of requests, returns the seconds to wait or 0
+        if not self.rate_limit:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate_limit, self.allowance + (now - self.last_refill) * self.rate_limit)
+            self.last_refill = now
+            if self.allowance < 1:
+                self.counters['throttled'] += 1
+                return (1 - self.allowance) / self.rate_limit
+            self.allowance -= 1
+            return 0
+
+    def handle(self, path, query):
+        # returns (status, headers, body)
+        retry_after = self.throttle()
+        if retry_after:
+            return 429, {'Retry-After': str(math.ceil(retry_after))}, {'message': 'Too many requests'}
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if path == '/api/v4/feed/private':
+            pagination_token = query.get('paginationToken', [None])[0]
+            if pagination_token not in self.feed_pages:
+                return 400, {}, {'message': 'Invalid pagination token'}
+            with self.lock:
+                self.counters['feed_requests'] += 1
+            return 200, {}, self.feed_pages[pagination_token]
+        if path.startswith('/api/v3/games/'):
+            token = path.rsplit('/', 1)[1]
+            if token not in self.known_tokens:
+                return 404, {}, {'message': 'Game not found'}
+            with self.lock:
+                self.counters['game_requests'] += 1
+            return 200, {}, synthetic_data.make_game(token, self.seed)
+        return 404, {}, {'message': 'Not found'}
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this every response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if '_ncfa=' not in self.headers.get('Cookie', ''):
+            status, headers, body = 401, {}, {'message': 'Unauthorized'}
+        else:
+            status, headers, body = self.server.api.handle(url.path, parse_qs(url.query))
+        data = json.dumps(body).encode()
+        with self.server.api.lock:
+            self.server.api.counters['bytes_sent'] += len(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(api, host='127.0.0.1', port=0):
+    # port 0 picks a free port, the chosen one is server.server_address[1]
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.api = api
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic GeoGuessr feed and game data.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--games', type=int, default=1000, help='number of games in the feed')
+    parser.add_argument('--page-size', type=int, default=10, help='feed entries per page')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, up to this many seconds')
+    parser.add_argument('--rate-limit', type=float, default=None, help='requests per second before answering 429')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    api = MockGeoGuessr(args.games, args.page_size, args.latency, args.jitter, args.rate_limit, args.seed)
+    server = start_server(api, args.host, args.port)
+    print(f'Serving {args.games} synthetic games on http://{args.host}:{server.server_address[1]}/api')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks import synthetic_data
+from benchmarks.mock_server import MockGeoGuessr, start_server
+
+# measures GeoInsight against the local stand-in server, e.g.
+#   python -m benchmarks.run_benchmarks --sizes 100 1000 10000 --latency 0.02 --json results.json
+
+class NullProgress:
+    def progress(self, *args):
+        pass
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def bench_feed(utils, session, api):
+    api.reset_counters()
+    game_tokens, elapsed = timed(utils.get_game_tokens, session)
+    return game_tokens, {'feed_pages': api.counters['feed_requests'],
+                         'feed_seconds': elapsed,
+                         'feed_pages_per_sec': api.counters['feed_requests'] / elapsed}
+
+def bench_games(utils, session, api, game_tokens):
+    api.reset_counters()
+    stats, elapsed = timed(utils.get_stats, session, game_tokens, len(game_tokens), NullProgress())
+    analyzed = sum(stats[mode]['number_of_games'] for mode in utils.MODES)
+    return stats, {'games_analyzed': analyzed,
+                   'games_dropped': len(game_tokens) - analyzed,
+                   'dropped_reasons': stats['dropped_games'],
+                   'games_seconds': elapsed,
+                   'games_per_sec': analyzed / elapsed,
+                   'throttled_requests': api.counters['throttled'],
+                   'megabytes_received': api.counters['bytes_sent'] / 1e6}
+
+def bench_pipelined(utils, session, api, number_of_games, scheduler=None):
+    # feed paging and game requests together, the games of each page are fetched while the next one loads
+    api.reset_counters()
+    name = 'pipelined_scheduler' if scheduler else 'pipelined'
+    token_pages = utils.iter_game_tokens(session, scheduler=scheduler)
+    stats, elapsed = timed(utils.get_stats, session, token_pages, number_of_games, NullProgress(), scheduler=scheduler)
+    analyzed = sum(stats[mode]['number_of_games'] for mode in utils.MODES)
+    return {f'{name}_seconds': elapsed,
+            f'{name}_games_per_sec': analyzed / elapsed}
+
+def bench_aggregation(utils, game_tokens):
+    games = [synthetic_data.make_game(token) for token in game_tokens]
+    # the one-off cost of loading the country shapes for reverse geocoding is not part of the aggregation time
+    utils.get_coast_shapes()
+    tracemalloc.start()
+    accumulator, parse_seconds = timed(utils.accumulate_games, games)
+    stats, summarize_seconds = timed(accumulator.to_stats)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rounds = sum(stats[mode]['number_of_rounds'] for mode in utils.MODES)
+    per_10k_rounds = 10000 / max(rounds, 1)
+    return {'rounds': rounds,
+            'parse_seconds_per_10k_rounds': parse_seconds * per_10k_rounds,
+            'aggregate_seconds_per_10k_rounds': summarize_seconds * per_10k_rounds,
+            'peak_megabytes': peak / 1e6}
+
+def bench_figures(utils, stats):
+    stats = stats['moving']
+    plots = {'points_vs_time': lambda: utils.plot_points_vs_time(stats),
+             'points_histogram': lambda: utils.points_histogram(stats),
+             'guess_directions': lambda: utils.plot_guess_directions(stats),
+             'countries_bar_chart': lambda: utils.plot_countries_bar_chart(stats),
+             'guessed_locations': lambda: utils.plot_guessed_locations(stats['guessed_locations'])}
+    # the world map's one-off basemap cost is not part of the per-figure time
+    utils.get_basemap()
+    results = {}
+    for name, plot in plots.items():
+        start = time.perf_counter()
+        fig = plot()
+        fig.canvas.draw()
+        results[f'render_seconds_{name}'] = time.perf_counter() - start
+
+    # all figures to PNG as the app does it, in this process and in warmed-up worker processes
+    _, results['png_seconds_serial'] = timed(utils.render_figures, stats)
+    with ProcessPoolExecutor(utils.FIGURE_WORKERS, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for future in [pool.submit(utils.warm_up_figure_worker) for _ in range(utils.FIGURE_WORKERS)]:
+            future.result()
+        _, results['png_seconds_parallel'] = timed(utils.render_figures, stats, pool)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GeoInsight against a local GeoGuessr stand-in.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='numbers of games to analyze')
+    parser.add_argument('--page-size', type=int, default=10, help='feed entries per page')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, up to this many seconds')
+    parser.add_argument('--rate-limit', type=float, default=None, help='requests per second before answering 429')
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    server = start_server(MockGeoGuessr(0))
+    os.environ['GEOINSIGHT_API_URL'] = f'http://127.0.0.1:{server.server_address[1]}/api'
+    # utils reads GEOINSIGHT_API_URL when it is imported
+    import utils
+    import fetch_scheduler
+    # the stand-in server's --rate-limit is the only limit on the request rate
+    scheduler = fetch_scheduler.FetchScheduler(max_requests_per_sec=0)
+
+    results = []
+    for size in args.sizes:
+        api = server.api = MockGeoGuessr(size, args.page_size, args.latency, args.jitter, args.rate_limit)
+        session = utils.get_session('benchmark')
+        result = {'size': size}
+        game_tokens, feed_result = bench_feed(utils, session, api)
+        result.update(feed_result)
+        stats, games_result = bench_games(utils, session, api, game_tokens)
+        result.update(games_result)
+        result.update(bench_pipelined(utils, session, api, size))
+        result.update(bench_pipelined(utils, utils.get_session('benchmark', scheduler=scheduler), api, size, scheduler))
+        result.update(bench_aggregation(utils, game_tokens))
+        result.update(bench_figures(utils, stats))
+        results.append(result)
+        print(f'--- {size} games')
+        for name, value in result.items():
+            print(f'{name:>40}: {value:.4f}' if isinstance(value, float) else f'{name:>40}: {value}')
+
+    server.shutdown()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
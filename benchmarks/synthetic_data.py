@@ -0,0 +1,159 @@
+import json
+import math
+import random
+import hashlib
+
+# (country code, lat, lng, spread in degrees) of the places synthetic rounds are dropped in
+LOCATIONS = [
+    ('us', 39.8, -98.6, 10.0), ('ca', 53.0, -100.0, 8.0), ('mx', 23.6, -102.5, 5.0),
+    ('br', -10.3, -53.2, 8.0), ('ar', -34.0, -64.0, 6.0), ('cl', -33.0, -71.0, 3.0),
+    ('gb', 53.0, -1.5, 2.0), ('fr', 46.6, 2.4, 2.5), ('de', 51.1, 10.4, 2.0),
+    ('es', 40.2, -3.6, 2.5), ('it', 42.8, 12.5, 2.0), ('pl', 52.0, 19.4, 2.0),
+    ('se', 62.0, 15.0, 4.0), ('no', 61.0, 9.0, 3.0), ('fi', 64.0, 26.0, 3.0),
+    ('ru', 56.0, 45.0, 10.0), ('ua', 49.0, 31.4, 3.0), ('tr', 39.0, 35.2, 3.0),
+    ('za', -29.0, 25.0, 4.0), ('ke', 0.2, 37.9, 2.0), ('ng', 9.1, 8.7, 3.0),
+    ('in', 22.0, 79.0, 6.0), ('th', 15.8, 101.0, 3.0), ('id', -2.5, 118.0, 6.0),
+    ('jp', 36.2, 138.3, 3.0), ('kr', 36.5, 127.9, 1.5), ('au', -25.3, 133.8, 10.0),
+    ('nz', -41.0, 174.0, 3.0), ('ph', 12.9, 121.8, 3.0), ('co', 4.6, -74.1, 3.0),
+]
+
+# forbidMoving, forbidZooming, forbidRotating
+GAME_MODES = {'moving': (False, False, False),
+              'no-moving': (True, False, False),
+              'nmpz': (True, True, True)}
+
+EARTH_RADIUS_KM = 6371.0
+# GeoGuessr's score falloff for the world map
+SCORE_DECAY_KM = 1492.7
+
+def make_rng(*seed):
+    return random.Random(hashlib.sha256(repr(seed).encode()).digest())
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def make_game_tokens(number_of_games, seed=0):
+    rng = make_rng('tokens', seed)
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    return [''.join(rng.choice(alphabet) for _ in range(16)) for _ in range(number_of_games)]
+
+def make_game(token, seed=0):
+    # a finished 5 round singleplayer game shaped like /api/v3/games/{token}
+    rng = make_rng('game', token, seed)
+    mode = rng.choices(list(GAME_MODES), weights=[5, 3, 2])[0]
+    forbid_moving, forbid_zooming, forbid_rotating = GAME_MODES[mode]
+    skill = rng.uniform(0.5, 2.0)
+
+    rounds = []
+    guesses = []
+    for _ in range(5):
+        country_code, lat, lng, spread = rng.choice(LOCATIONS)
+        actual_lat = max(-85.0, min(85.0, rng.gauss(lat, spread)))
+        actual_lng = (rng.gauss(lng, spread) + 180) % 360 - 180
+        # most guesses land close by, a few are in another part of the world
+        if rng.random() < 0.1:
+            _, guess_lat, guess_lng, _ = rng.choice(LOCATIONS)
+        else:
+            guess_lat = max(-85.0, min(85.0, actual_lat + rng.gauss(0, 3 * skill)))
+            guess_lng = (actual_lng + rng.gauss(0, 4 * skill) + 180) % 360 - 180
+        distance_km = haversine_km(actual_lat, actual_lng, guess_lat, guess_lng)
+        score = int(round(5000 * math.exp(-distance_km / SCORE_DECAY_KM)))
+        time_sec = max(3, int(rng.lognormvariate(3.6, 0.6)))
+        rounds.append({'lat': actual_lat,
+                       'lng': actual_lng,
+                       'panoId': None,
+                       'heading': rng.uniform(0, 360),
+                       'pitch': 0,
+                       'zoom': 0,
+                       'streakLocationCode': country_code,
+                       'startTime': None})
+        guesses.append({'lat': guess_lat,
+                        'lng': guess_lng,
+                        'timedOut': False,
+                        'timedOutWithGuess': False,
+                        'skippedRound': False,
+                        'roundScore': {'amount': str(score), 'unit': 'points', 'percentage': score / 50},
+                        'roundScoreInPercentage': score / 50,
+                        'roundScoreInPoints': score,
+                        'distance': {'meters': {'amount': f'{distance_km:.1f}', 'unit': 'km'},
+                                     'miles': {'amount': f'{distance_km * 0.621371:.1f}', 'unit': 'miles'}},
+                        'distanceInMeters': distance_km * 1000,
+                        'stepsCount': 0 if forbid_moving else rng.randint(0, 200),
+                        'streakLocationCode': None,
+                        'time': time_sec})
+
+    total_score = sum(guess['roundScoreInPoints'] for guess in guesses)
+    total_distance_km = sum(guess['distanceInMeters'] for guess in guesses) / 1000
+    return {'token': token,
+            'type': 'standard',
+            'mode': 'standard',
+            'state': 'finished',
+            'roundCount': 5,
+            'timeLimit': 0,
+            'forbidMoving': forbid_moving,
+            'forbidZooming': forbid_zooming,
+            'forbidRotating': forbid_rotating,
+            'streakType': 'countrystreak',
+            'map': 'world',
+            'mapName': 'World',
+            'panoramaProvider': 1,
+            'bounds': {'min': {'lat': -65.0, 'lng': -180.0}, 'max': {'lat': 78.0, 'lng': 180.0}},
+            'round': 5,
+            'rounds': rounds,
+            'player': {'totalScore': {'amount': str(total_score), 'unit': 'points', 'percentage': total_score / 250},
+                       'totalDistance': {'meters': {'amount': f'{total_distance_km:.1f}', 'unit': 'km'},
+                                         'miles': {'amount': f'{total_distance_km * 0.621371:.1f}', 'unit': 'miles'}},
+                       'totalDistanceInMeters': total_distance_km * 1000,
+                       'totalStepsCount': sum(guess['stepsCount'] for guess in guesses),
+                       'totalTime': sum(guess['time'] for guess in guesses),
+                       'totalStreak': 0,
+                       'guesses': guesses,
+                       'isLeader': True,
+                       'currentPosition': 0,
+                       'pin': {'url': '', 'anchor': 'center-center', 'isDefault': True},
+                       'newBadges': [],
+                       'explorer': None,
+                       'id': 'synthetic-player',
+                       'nick': 'synthetic',
+                       'isVerified': False,
+                       'flair': 0,
+                       'countryCode': 'us'},
+            'progressChange': None}
+
+def make_feed_entry(tokens, seed=0):
+    # one entry of /api/v4/feed/private, its payload is a JSON string listing one or more activities
+    rng = make_rng('entry', tokens[0] if tokens else None, seed)
+    activities = [{'type': 1,
+                   'time': '2024-01-01T00:00:00.000Z',
+                   'payload': {'mapSlug': 'world', 'mapName': 'World', 'points': rng.randint(0, 25000),
+                               'gameToken': token, 'gameMode': 'Standard'}}
+                  for token in tokens]
+    # other activity types show up in the same feed and have to be skipped
+    if rng.random() < 0.2:
+        activities.append({'type': 6,
+                           'time': '2024-01-01T00:00:00.000Z',
+                           'payload': {'gameId': f'duel-{rng.getrandbits(32):08x}', 'gameMode': 'Duels'}})
+    return {'type': 7, 'time': '2024-01-01T00:00:00.000Z', 'user': {'id': 'synthetic-player'},
+            'payload': json.dumps(activities)}
+
+def make_feed_pages(game_tokens, page_size=10, seed=0):
+    # {pagination token: feed page}, the first page is under None
+    rng = make_rng('feed', seed)
+    entries = []
+    i = 0
+    while i < len(game_tokens):
+        group_size = rng.choice([1, 1, 1, 2, 3])
+        entries.append(make_feed_entry(game_tokens[i:i + group_size], seed))
+        i += group_size
+
+    pages = {}
+    page_tokens = [None] + [f'page-{start}' for start in range(page_size, len(entries), page_size)]
+    for i, pagination_token in enumerate(page_tokens):
+        next_token = page_tokens[i + 1] if i + 1 < len(page_tokens) else None
+        pages[pagination_token] = {'entries': entries[i * page_size:(i + 1) * page_size],
+                                   'paginationToken': next_token}
+    return pages
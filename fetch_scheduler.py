@@ -0,0 +1,141 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future
+
+# shared by every analysis running in this process
+FETCH_WORKERS = int(os.environ.get('GEOINSIGHT_FETCH_WORKERS', 32))
+MAX_REQUESTS_PER_SEC = float(os.environ.get('GEOINSIGHT_MAX_REQUESTS_PER_SEC', 40))
+# a client with nothing queued or running for this long is forgotten. Shorter gaps, e.g. between the
+# feed pages of one analysis, keep its service count so that it doesn't start over at 0
+CLIENT_IDLE_SEC = 30
+
+class FetchScheduler:
+    # Runs the feed and game requests of all clients (one per user session) on one pool of
+    # worker threads. Requests are started no faster than max_requests_per_sec overall, and the
+    # next one always comes from the client that has been served the fewest requests so far.
+    # Clients with equal service take turns, and a new or small analysis overtakes a big one
+    # that is already running, so it finishes in a time proportional to its own size.
+    # Within a client, requests go in the order they were submitted, except that those of
+    # submit_first go ahead of the client's queue, e.g. a feed page ahead of the games of the last one.
+    def __init__(self, max_workers=FETCH_WORKERS, max_requests_per_sec=MAX_REQUESTS_PER_SEC):
+        self.max_workers = max_workers
+        self.max_requests_per_sec = max_requests_per_sec
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.served = {}
+        self.running = {}
+        self.idle_since = {}
+        self.allowance = max_requests_per_sec or 0
+        self.last_refill = time.monotonic()
+        for _ in range(max_workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, client, function, *args, **kwargs):
+        return self._submit(client, False, function, args, kwargs)
+
+    def submit_first(self, client, function, *args, **kwargs):
+        return self._submit(client, True, function, args, kwargs)
+
+    def _submit(self, client, first, function, args, kwargs):
+        future = Future()
+        # like metrics.submit, the caller's context (and its metrics recorder) goes along
+        task = (future, contextvars.copy_context(), function, args, kwargs)
+        with self.condition:
+            self._forget_idle_clients()
+            self.idle_since.pop(client, None)
+            queue = self.queues.setdefault(client, deque())
+            if first:
+                queue.appendleft(task)
+            else:
+                queue.append(task)
+            self.served.setdefault(client, 0)
+            self.running.setdefault(client, 0)
+            self.condition.notify()
+        return future
+
+    def take_token(self):
+        # for a request a worker sends again, see utils.CountingRetry, so that retries count
+        # against max_requests_per_sec like any other request
+        if not self.max_requests_per_sec:
+            return
+        with self.condition:
+            while True:
+                self._refill()
+                if self.allowance >= 1:
+                    self.allowance -= 1
+                    return
+                self.condition.wait((1 - self.allowance) / self.max_requests_per_sec)
+
+    def run(self, client, function, *args, **kwargs):
+        return self.submit(client, function, *args, **kwargs).result()
+
+    def run_first(self, client, function, *args, **kwargs):
+        return self.submit_first(client, function, *args, **kwargs).result()
+
+    def queued(self):
+        with self.condition:
+            return {client: len(queue) for client, queue in self.queues.items() if queue}
+
+    def _refill(self):
+        now = time.monotonic()
+        self.allowance = min(self.max_requests_per_sec,
+                             self.allowance + (now - self.last_refill) * self.max_requests_per_sec)
+        self.last_refill = now
+
+    def _pop_task(self):
+        # least attained service first, cancelled tasks are dropped on the way
+        while True:
+            clients = [client for client, queue in self.queues.items() if queue]
+            if not clients:
+                return None, None
+            client = min(clients, key=self.served.get)
+            task = self.queues[client].popleft()
+            if not task[0].cancelled():
+                self.served[client] += 1
+                self.running[client] += 1
+                return client, task
+            self._mark_if_idle(client)
+
+    def _mark_if_idle(self, client):
+        if not self.queues[client] and not self.running[client]:
+            self.idle_since[client] = time.monotonic()
+
+    def _forget_idle_clients(self):
+        now = time.monotonic()
+        for client in [client for client, since in self.idle_since.items() if now - since > CLIENT_IDLE_SEC]:
+            del self.queues[client], self.served[client], self.running[client], self.idle_since[client]
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not any(self.queues.values()):
+                        self.condition.wait()
+                        continue
+                    if self.max_requests_per_sec:
+                        self._refill()
+                        if self.allowance < 1:
+                            self.condition.wait((1 - self.allowance) / self.max_requests_per_sec)
+                            continue
+                    client, task = self._pop_task()
+                    if task is None:
+                        continue
+                    if self.max_requests_per_sec:
+                        self.allowance -= 1
+                    break
+
+            future, context, function, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = context.run(function, *args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+            with self.condition:
+                self.running[client] -= 1
+                self._mark_if_idle(client)
@@ -0,0 +1,109 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+# set GEOINSIGHT_CACHE=0 to never write game data to disk
+CACHE_ENABLED = os.environ.get('GEOINSIGHT_CACHE', '1') != '0'
+CACHE_DIR = os.environ.get('GEOINSIGHT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'geo-insight'))
+CACHE_MAX_SIZE_MB = float(os.environ.get('GEOINSIGHT_CACHE_MAX_SIZE_MB', 256))
+
+# sqlite limits the number of host parameters in a single statement
+QUERY_CHUNK_SIZE = 500
+
+class GameStore:
+    def __init__(self, cache_dir=CACHE_DIR, max_size_mb=CACHE_MAX_SIZE_MB):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'games.sqlite3')
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS games (
+                                           token TEXT PRIMARY KEY,
+                                           data BLOB NOT NULL,
+                                           size INTEGER NOT NULL,
+                                           last_used REAL NOT NULL)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS games_last_used ON games (last_used)')
+            # feed token lists keyed by a hash of the account's cookie, newest token first
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS feeds (
+                                           account TEXT PRIMARY KEY,
+                                           tokens TEXT NOT NULL,
+                                           last_used REAL NOT NULL)''')
+
+    def get_many(self, tokens):
+        games = {}
+        tokens = list(tokens)
+        now = time.time()
+        with self.lock, self.connection:
+            for start in range(0, len(tokens), QUERY_CHUNK_SIZE):
+                chunk = tokens[start:start + QUERY_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(f'SELECT token, data FROM games WHERE token IN ({placeholders})', chunk)
+                for token, data in rows:
+                    games[token] = json.loads(zlib.decompress(data))
+                self.connection.execute(f'UPDATE games SET last_used = ? WHERE token IN ({placeholders})', [now, *chunk])
+        return games
+
+    def put_many(self, games):
+        now = time.time()
+        rows = []
+        for token, game in games.items():
+            data = zlib.compress(json.dumps(game, separators=(',', ':')).encode())
+            rows.append((token, data, len(data), now))
+        if not rows:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?)', rows)
+            self._evict()
+
+    def get_feed(self, account):
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT tokens FROM feeds WHERE account = ?', (account,)).fetchone()
+            if row:
+                self.connection.execute('UPDATE feeds SET last_used = ? WHERE account = ?', (time.time(), account))
+        return json.loads(row[0]) if row else []
+
+    def put_feed(self, account, tokens):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO feeds VALUES (?, ?, ?)', (account, json.dumps(tokens), time.time()))
+            self._evict()
+
+    def size(self):
+        with self.lock:
+            return self._get_size()
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM games')
+            self.connection.execute('DELETE FROM feeds')
+        with self.lock:
+            self.connection.execute('VACUUM')
+
+    def _get_size(self):
+        # the feeds' token lists count towards max_size_bytes too, tokens are ASCII so characters are bytes
+        return self.connection.execute('''SELECT (SELECT COALESCE(SUM(size), 0) FROM games)
+                                                 + (SELECT COALESCE(SUM(LENGTH(tokens)), 0) FROM feeds)''').fetchone()[0]
+
+    def _evict(self):
+        # drop the least recently used games and feeds until the store fits in max_size_bytes
+        total_size = self._get_size()
+        if total_size <= self.max_size_bytes:
+            return
+        evicted = {'games': [], 'feeds': []}
+        rows = self.connection.execute('''SELECT 'games', token, size, last_used FROM games
+                                          UNION ALL
+                                          SELECT 'feeds', account, LENGTH(tokens), last_used FROM feeds
+                                          ORDER BY last_used''')
+        for table, key, size, _ in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            evicted[table].append((key,))
+            total_size -= size
+        self.connection.executemany('DELETE FROM games WHERE token = ?', evicted['games'])
+        self.connection.executemany('DELETE FROM feeds WHERE account = ?', evicted['feeds'])
+
+def is_finished(game):
+    return game.get('state') == 'finished'
@@ -0,0 +1,84 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('geo_insight')
+# e.g. GEOINSIGHT_LOG_LEVEL=INFO logs the metrics of every analysis as one JSON line
+if os.environ.get('GEOINSIGHT_LOG_LEVEL'):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(os.environ['GEOINSIGHT_LOG_LEVEL'].upper())
+
+# the recorder of the analysis running in this context, utils records into it when one is set
+current_recorder = contextvars.ContextVar('current_recorder', default=None)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(phase, {'count': 0, 'total_sec': 0.0, 'max_sec': 0.0})
+            timing['count'] += 1
+            timing['total_sec'] += seconds
+            timing['max_sec'] = max(timing['max_sec'], seconds)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return {'timings': {phase: dict(timing) for phase, timing in self.timings.items()},
+                    'counters': dict(self.counters)}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+@contextlib.contextmanager
+def recording(recorder):
+    # everything utils does inside this block, including its worker threads, is recorded
+    token = current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        current_recorder.reset(token)
+        logger.info('metrics %s', recorder.to_json())
+
+@contextlib.contextmanager
+def timer(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        recorder = current_recorder.get()
+        if recorder is not None:
+            recorder.add_time(phase, seconds)
+        logger.debug('%s took %.4fs', phase, seconds)
+
+def timed(phase):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def increment(name, value=1):
+    recorder = current_recorder.get()
+    if recorder is not None:
+        recorder.increment(name, value)
+
+def submit(executor, function, *args):
+    # ThreadPoolExecutor doesn't carry context variables over to its workers
+    return executor.submit(contextvars.copy_context().run, function, *args)
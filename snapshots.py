@@ -0,0 +1,59 @@
+import io
+import json
+import time
+
+import utils
+
+# A saved analysis is its round table as a Parquet file written with pyarrow, with the snapshot
+# version, the dropped games and the sample, if any, in the file's metadata. The stats are computed
+# from the round table again when it is read, without any requests. Most of that is the reverse
+# geocoding and geodesic step of to_stats, which takes under a second for 50k rounds
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_METADATA_KEY = b'geo_insight'
+
+def write_snapshot(stats, file):
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    round_table = pd.concat([stats[mode]['rounds'] for mode in utils.MODES], ignore_index=True)
+    table = pa.Table.from_pandas(round_table, preserve_index=False)
+    metadata = {'version': SNAPSHOT_VERSION,
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'dropped_games': stats['dropped_games'],
+                'sample': stats.get('sample')}
+    table = table.replace_schema_metadata({**table.schema.metadata, SNAPSHOT_METADATA_KEY: json.dumps(metadata).encode()})
+    pq.write_table(table, file, compression='zstd')
+
+def get_snapshot_bytes(stats):
+    buffer = io.BytesIO()
+    write_snapshot(stats, buffer)
+    return buffer.getvalue()
+
+def read_snapshot(file):
+    # returns (stats, metadata), raises ValueError for anything that is not a snapshot of this version
+    import pyarrow.parquet as pq
+    table = pq.read_table(file)
+    metadata = (table.schema.metadata or {}).get(SNAPSHOT_METADATA_KEY)
+    if metadata is None:
+        raise ValueError('not a GeoInsight snapshot')
+    metadata = json.loads(metadata)
+    if metadata.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {metadata.get('version')}")
+    missing_columns = set(utils.ROUND_COLUMNS) - set(table.column_names)
+    if missing_columns:
+        raise ValueError(f"snapshot is missing the columns {', '.join(sorted(missing_columns))}")
+
+    stats = utils.accumulate_round_table(table.to_pandas()).to_stats()
+    stats['dropped_games'] = metadata['dropped_games']
+    stats['sample'] = None
+    if metadata.get('sample'):
+        # an analysis of a sample stays an estimate
+        utils.add_sample_estimates(stats, metadata['sample']['population_games'])
+    return stats, metadata
+
+def diff_stats(stats, earlier_stats):
+    # change of the headline numbers of one mode since an earlier analysis
+    keys = ['number_of_games', 'number_of_rounds', 'average_score', 'average_distance', 'average_time',
+            'correct_country_rate']
+    return {key: stats[key] - earlier_stats[key] for key in keys}
@@ -1,14 +1,114 @@
+import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
-from shapely.geometry import Point
-import geopandas as gpd
-from geopandas import GeoDataFrame
+from urllib.parse import urlparse
+import hashlib
+import io
+import functools
+import heapq
+import itertools
+import random
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from game_store import is_finished
+import metrics
 
-BASE_URL_V4 = "https://www.geoguessr.com/api/v4"
-BASE_URL_V3 = "https://www.geoguessr.com/api/v3"
+# orjson decodes several times faster than the standard library and is used when installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# GEOINSIGHT_API_URL points the app at another server, e.g. benchmarks/mock_server.py
+API_URL = os.environ.get('GEOINSIGHT_API_URL', "https://www.geoguessr.com/api").rstrip('/')
+BASE_URL_V4 = f"{API_URL}/v4"
+BASE_URL_V3 = f"{API_URL}/v3"
+
+# number of games fetched in parallel by get_stats, also the size of the session's connection pool
+MAX_WORKERS = 10
+
+# transient failures (rate limiting, 5xx, dropped connections) are retried with exponential backoff
+# of REQUEST_BACKOFF_SEC * 2 ** retry, a Retry-After header from the server takes precedence
+MAX_RETRIES = 5
+REQUEST_BACKOFF_SEC = 0.5
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# longest a Retry-After header may make a worker wait, which with a shared scheduler holds up every user
+MAX_RETRY_AFTER_SEC = 30
+REQUEST_TIMEOUT_SEC = 30
+
+# number of games between two partial results of iter_stats
+STREAM_BATCH_SIZE = 50
+
+# how often an analysis with an AnalysisBudget checks whether it should stop
+BUDGET_POLL_SEC = 0.1
+
+# processes the app draws figures in, see render_figures
+FIGURE_WORKERS = int(os.environ.get('GEOINSIGHT_FIGURE_WORKERS', min(4, os.cpu_count() or 1)))
+# figures of a mode in display order, with the stats each one is drawn from
+FIGURE_STATS = {'countries_bar_chart': ['countries'],
+                'points_vs_time': ['round_wise_time', 'round_wise_points'],
+                'points_histogram': ['points_histogram'],
+                'guess_directions': ['direction_histogram'],
+                'guessed_locations': ['guessed_locations']}
+# above this many rounds the scatter plots show binned densities instead of one marker per round
+DENSITY_THRESHOLD = int(os.environ.get('GEOINSIGHT_DENSITY_THRESHOLD', 5000))
+# bounds of the points buckets counted in stats['points_histogram']
+POINTS_BUCKETS = [0, 1000, 2000, 3000, 4000, 5000]
+# the naturalearth coastlines are coarse, a guess in the sea at most this many degrees from a country is put in it
+COAST_TOLERANCE_DEG = 0.25
+# mean radius, the great-circle distances are on a sphere
+EARTH_RADIUS_KM = 6371.0088
+# compass sectors of the direction histogram, clockwise from north
+DIRECTIONS = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
+# countries with fewer rounds in a mode are left out of its offsets per country
+MIN_OFFSET_ROUNDS = 3
+# most frequent (actual country, guessed country) pairs of wrong guesses kept per mode
+CONFUSION_PAIRS = 10
+
+# games analyzed when the stats are estimated from a sample, see sample_game_tokens
+SAMPLE_SIZE = int(os.environ.get('GEOINSIGHT_SAMPLE_SIZE', 200))
+# of the normal distribution, for the 95% confidence intervals of estimated averages
+CONFIDENCE_Z = 1.96
+
+MODES = ['moving', 'no-moving', 'nmpz']
+
+# lng/lat bounds of the world map
+WORLD_EXTENT = (-180, 180, -90, 90)
+# Natural Earth's 1:110m countries, the naturalearth_lowres dataset geopandas used to ship
+WORLD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'naturalearth_lowres',
+                          'naturalearth_lowres.shp')
+
+# pandas, numpy, matplotlib and geopandas take over a second to import, so they are imported
+# inside the functions that need them and the app's first page doesn't wait for them.
+# benchmarks/import_budget.py checks this
+
+# one row per played round, see get_game_rounds and make_guess_table. The round tables of to_stats also
+# have the country of the guess, guess_country, and the columns of get_guess_offsets
+ROUND_COLUMNS = ['mode', 'game_token', 'round', 'country', 'score', 'distance', 'time',
+                 'guess_lat', 'guess_lng', 'actual_lat', 'actual_lng']
+# mode is made a categorical of MODES in make_guess_table
+# columns of the result of get_guess_offsets
+OFFSET_COLUMNS = ['great_circle_km', 'bearing', 'north_km', 'east_km']
+# columns the round tables of to_stats have besides ROUND_COLUMNS
+GUESS_COLUMNS = ['guess_country'] + OFFSET_COLUMNS
+# categorical columns of the round tables of to_stats, StatsAccumulator keeps them as codes until then
+CATEGORY_COLUMNS = ['game_token', 'country', 'guess_country']
+ROUND_DTYPES = {'mode': 'category',
+                'game_token': 'category',
+                'round': 'int8',
+                'country': 'category',
+                'score': 'int16',
+                'distance': 'float64',
+                'time': 'float64',
+                'guess_lat': 'float64',
+                'guess_lng': 'float64',
+                'actual_lat': 'float64',
+                'actual_lng': 'float64'}
 
 country_codes = {
     'ad': 'Andorra',
@@ -263,216 +363,938 @@ country_codes = {
     'zw': 'Zimbabwe',
 }
 
-def get_session(ncfa):
+# iso_a3 of the countries in get_world to the codes of country_codes. naturalearth has no code for Kosovo and
+# its own for N. Cyprus and Somaliland
+iso_a3_codes = {
+    '-99': 'xk',
+    'AFG': 'af',
+    'AGO': 'ao',
+    'ALB': 'al',
+    'ARE': 'ae',
+    'ARG': 'ar',
+    'ARM': 'am',
+    'ATA': 'aq',
+    'ATF': 'tf',
+    'AUS': 'au',
+    'AUT': 'at',
+    'AZE': 'az',
+    'BDI': 'bi',
+    'BEL': 'be',
+    'BEN': 'bj',
+    'BFA': 'bf',
+    'BGD': 'bd',
+    'BGR': 'bg',
+    'BHS': 'bs',
+    'BIH': 'ba',
+    'BLR': 'by',
+    'BLZ': 'bz',
+    'BOL': 'bo',
+    'BRA': 'br',
+    'BRN': 'bn',
+    'BTN': 'bt',
+    'BWA': 'bw',
+    'CAF': 'cf',
+    'CAN': 'ca',
+    'CHE': 'ch',
+    'CHL': 'cl',
+    'CHN': 'cn',
+    'CIV': 'ci',
+    'CMR': 'cm',
+    'COD': 'cd',
+    'COG': 'cg',
+    'COL': 'co',
+    'CRI': 'cr',
+    'CUB': 'cu',
+    'CYN': 'cy',
+    'CYP': 'cy',
+    'CZE': 'cz',
+    'DEU': 'de',
+    'DJI': 'dj',
+    'DNK': 'dk',
+    'DOM': 'do',
+    'DZA': 'dz',
+    'ECU': 'ec',
+    'EGY': 'eg',
+    'ERI': 'er',
+    'ESH': 'eh',
+    'ESP': 'es',
+    'EST': 'ee',
+    'ETH': 'et',
+    'FIN': 'fi',
+    'FJI': 'fj',
+    'FLK': 'fk',
+    'FRA': 'fr',
+    'GAB': 'ga',
+    'GBR': 'gb',
+    'GEO': 'ge',
+    'GHA': 'gh',
+    'GIN': 'gn',
+    'GMB': 'gm',
+    'GNB': 'gw',
+    'GNQ': 'gq',
+    'GRC': 'gr',
+    'GRL': 'gl',
+    'GTM': 'gt',
+    'GUY': 'gy',
+    'HND': 'hn',
+    'HRV': 'hr',
+    'HTI': 'ht',
+    'HUN': 'hu',
+    'IDN': 'id',
+    'IND': 'in',
+    'IRL': 'ie',
+    'IRN': 'ir',
+    'IRQ': 'iq',
+    'ISL': 'is',
+    'ISR': 'il',
+    'ITA': 'it',
+    'JAM': 'jm',
+    'JOR': 'jo',
+    'JPN': 'jp',
+    'KAZ': 'kz',
+    'KEN': 'ke',
+    'KGZ': 'kg',
+    'KHM': 'kh',
+    'KOR': 'kr',
+    'KWT': 'kw',
+    'LAO': 'la',
+    'LBN': 'lb',
+    'LBR': 'lr',
+    'LBY': 'ly',
+    'LKA': 'lk',
+    'LSO': 'ls',
+    'LTU': 'lt',
+    'LUX': 'lu',
+    'LVA': 'lv',
+    'MAR': 'ma',
+    'MDA': 'md',
+    'MDG': 'mg',
+    'MEX': 'mx',
+    'MKD': 'mk',
+    'MLI': 'ml',
+    'MMR': 'mm',
+    'MNE': 'me',
+    'MNG': 'mn',
+    'MOZ': 'mz',
+    'MRT': 'mr',
+    'MWI': 'mw',
+    'MYS': 'my',
+    'NAM': 'na',
+    'NCL': 'nc',
+    'NER': 'ne',
+    'NGA': 'ng',
+    'NIC': 'ni',
+    'NLD': 'nl',
+    'NOR': 'no',
+    'NPL': 'np',
+    'NZL': 'nz',
+    'OMN': 'om',
+    'PAK': 'pk',
+    'PAN': 'pa',
+    'PER': 'pe',
+    'PHL': 'ph',
+    'PNG': 'pg',
+    'POL': 'pl',
+    'PRI': 'pr',
+    'PRK': 'kp',
+    'PRT': 'pt',
+    'PRY': 'py',
+    'PSE': 'ps',
+    'QAT': 'qa',
+    'ROU': 'ro',
+    'RUS': 'ru',
+    'RWA': 'rw',
+    'SAU': 'sa',
+    'SDN': 'sd',
+    'SEN': 'sn',
+    'SLB': 'sb',
+    'SLE': 'sl',
+    'SLV': 'sv',
+    'SOL': 'so',
+    'SOM': 'so',
+    'SRB': 'rs',
+    'SSD': 'ss',
+    'SUR': 'sr',
+    'SVK': 'sk',
+    'SVN': 'si',
+    'SWE': 'se',
+    'SWZ': 'sz',
+    'SYR': 'sy',
+    'TCD': 'td',
+    'TGO': 'tg',
+    'THA': 'th',
+    'TJK': 'tj',
+    'TKM': 'tm',
+    'TLS': 'tl',
+    'TTO': 'tt',
+    'TUN': 'tn',
+    'TUR': 'tr',
+    'TWN': 'tw',
+    'TZA': 'tz',
+    'UGA': 'ug',
+    'UKR': 'ua',
+    'URY': 'uy',
+    'USA': 'us',
+    'UZB': 'uz',
+    'VEN': 've',
+    'VNM': 'vn',
+    'VUT': 'vu',
+    'YEM': 'ye',
+    'ZAF': 'za',
+    'ZMB': 'zm',
+    'ZWE': 'zw',
+}
+# the countries get_world has a polygon for. Small ones such as Singapore, Malta or Andorra are not on
+# the 1:110m map, so a guess in them can't be placed in them
+MAPPED_COUNTRY_CODES = set(iso_a3_codes.values())
+
+class CountingRetry(Retry):
+    # urllib3 sends retries from inside the worker that made the request. With a scheduler, each
+    # retry waits for a token of its rate budget first, like a new request would
+    scheduler = None
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.scheduler = self.scheduler
+        return retry
+
+    def increment(self, *args, **kwargs):
+        metrics.increment('retries')
+        return super().increment(*args, **kwargs)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER_SEC)
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.scheduler is not None:
+            self.scheduler.take_token()
+
+def get_session(ncfa, pool_size=None, scheduler=None):
+    # pass the fetch_scheduler.FetchScheduler the session's requests will go through, if any
     session = requests.Session()
-    session.cookies.set("_ncfa", ncfa, domain="www.geoguessr.com")
+    session.cookies.set("_ncfa", ncfa, domain=urlparse(API_URL).hostname)
+    # requests already keeps connections alive and asks for gzip, the pool is sized so that every
+    # fetch worker can hold on to its own connection instead of opening a new one per game
+    if pool_size is None:
+        pool_size = scheduler.max_workers if scheduler is not None else MAX_WORKERS
+    retry = CountingRetry(total=MAX_RETRIES, backoff_factor=REQUEST_BACKOFF_SEC, status_forcelist=RETRY_STATUS_CODES,
+                          allowed_methods=['GET'], respect_retry_after_header=True,
+                          # the last response is returned once the retries run out, raise_for_status then
+                          # raises an HTTPError that carries its status code, see get_drop_reason
+                          raise_on_status=False)
+    retry.scheduler = scheduler
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
     return session
 
-def get_game_tokens(session):
-    game_tokens = []
+def get_drop_reason(exception):
+    if isinstance(exception, requests.exceptions.RetryError):
+        return 'server_error'
+    elif isinstance(exception, requests.exceptions.HTTPError):
+        status_code = exception.response.status_code
+        if status_code == 429:
+            return 'rate_limited'
+        # still failing after MAX_RETRIES
+        return 'server_error' if status_code in RETRY_STATUS_CODES else f'http_{status_code}'
+    elif isinstance(exception, requests.exceptions.Timeout):
+        return 'timeout'
+    elif isinstance(exception, requests.exceptions.ConnectionError):
+        return 'connection_error'
+    elif isinstance(exception, ValueError):
+        return 'invalid_json'
+    elif isinstance(exception, (KeyError, TypeError)):
+        # see compact_game
+        return 'unparsable'
+    return 'error'
+
+def drop_game(dropped_games, reason):
+    metrics.increment(f'games_dropped_{reason}')
+    if dropped_games is not None:
+        dropped_games[reason] = dropped_games.get(reason, 0) + 1
+
+class AnalysisBudget:
+    # Stops an analysis early, when cancel() is called from any thread or after time_budget_sec.
+    # The games fetched by then are analyzed, the rest are not requested or are cancelled,
+    # and stop_reason says why ('cancelled' or 'time_budget')
+    def __init__(self, time_budget_sec=None):
+        self.deadline = time.monotonic() + time_budget_sec if time_budget_sec else None
+        self.cancelled = threading.Event()
+        self.stop_reason = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_over(self):
+        if self.stop_reason is None:
+            if self.cancelled.is_set():
+                self.stop_reason = 'cancelled'
+            elif self.deadline is not None and time.monotonic() >= self.deadline:
+                self.stop_reason = 'time_budget'
+        return self.stop_reason is not None
+
+    def get_wait_timeout(self):
+        if self.deadline is None:
+            return BUDGET_POLL_SEC
+        return max(0, min(BUDGET_POLL_SEC, self.deadline - time.monotonic()))
+
+def get_account_key(ncfa):
+    return hashlib.sha256(ncfa.encode()).hexdigest()
+
+def get_feed_page(session, pagination_token):
+    with metrics.timer('feed_request'):
+        response = session.get(f"{BASE_URL_V4}/feed/private", params={'paginationToken': pagination_token},
+                               timeout=REQUEST_TIMEOUT_SEC)
+        response.raise_for_status()
+    metrics.increment('feed_requests')
+    metrics.increment('bytes_received', len(response.content))
+    return response
+
+def iter_game_tokens(session, known_tokens=(), scheduler=None):
+    # yields the standard game tokens of each feed page (newest first) and
+    # stops paging at the first token that is already in known_tokens.
+    # With a fetch_scheduler.FetchScheduler the requests are queued there, see iter_games, ahead of
+    # the session's game requests so that the next page isn't held up by the games of the last one
+    known_tokens = set(known_tokens)
     pagination_token = None
-    while True:
-        response = session.get(f"{BASE_URL_V4}/feed/private", params={'paginationToken': pagination_token})
-        pagination_token = entries = response.json()['paginationToken']
-        entries = response.json()['entries']
-        for entry in entries:
-            payload_json = json.loads(entry['payload'])
-            for payload in payload_json:
-                try:
-                    if payload['payload']['gameMode'] == 'Standard':
-                        game_tokens.append(payload['payload']['gameToken']) 
-                except Exception as e:
-                    continue 
+    reached_known_token = False
+    while not reached_known_token:
+        if scheduler is None:
+            response = get_feed_page(session, pagination_token)
+        else:
+            response = scheduler.run_first(id(session), get_feed_page, session, pagination_token)
+        page_tokens = []
+        with metrics.timer('feed_decode'):
+            feed = json_loads(response.content)
+            pagination_token = feed['paginationToken']
+            for entry in feed['entries']:
+                payload_json = json_loads(entry['payload'])
+                for payload in payload_json:
+                    try:
+                        if payload['payload']['gameMode'] == 'Standard':
+                            token = payload['payload']['gameToken']
+                            if token in known_tokens:
+                                reached_known_token = True
+                                break
+                            page_tokens.append(token)
+                    except Exception as e:
+                        continue
+                if reached_known_token:
+                    break
+        yield page_tokens
         if not pagination_token:
             break
+
+def get_game_tokens(session, known_tokens=(), scheduler=None):
+    new_tokens = [token for page_tokens in iter_game_tokens(session, known_tokens, scheduler) for token in page_tokens]
+    return new_tokens + list(known_tokens)
+
+def sync_game_tokens(session, account_key, game_store=None, scheduler=None):
+    known_tokens = game_store.get_feed(account_key) if game_store else []
+    game_tokens = get_game_tokens(session, known_tokens, scheduler)
+    if game_store and len(game_tokens) != len(known_tokens):
+        game_store.put_feed(account_key, game_tokens)
     return game_tokens
 
-def get_stats(session, game_tokens, number_of_games, progress_bar):
-    # moving stats
-    mov_total_score = 0
-    mov_total_distance_km = 0
-    mov_total_time_sec = 0
-    mov_round_wise_points = []
-    mov_round_wise_time = []
-    mov_guessed_locations = []
-    mov_points_lost_per_country = dict({})
-    mov_distance_per_country = dict({})
-    mov_countries = dict({})
-    mov_number_of_games = 0
-    mov_number_of_rounds = 0
-    
-    # no-moving stats
-    no_mov_total_score = 0
-    no_mov_total_distance_km = 0
-    no_mov_total_time_sec = 0
-    no_mov_round_wise_points = []
-    no_mov_round_wise_time = []
-    no_mov_guessed_locations = []
-    no_mov_points_lost_per_country = dict({})
-    no_mov_distance_per_country = dict({})
-    no_mov_countries = dict({})
-    no_mov_number_of_games = 0
-    no_mov_number_of_rounds = 0
-    
-    # nmpz stats
-    nmpz_total_score = 0
-    nmpz_total_distance_km = 0
-    nmpz_total_time_sec = 0
-    nmpz_round_wise_points = []
-    nmpz_round_wise_time = []
-    nmpz_guessed_locations = []
-    nmpz_points_lost_per_country = dict({})
-    nmpz_distance_per_country = dict({})
-    nmpz_countries = dict({})
-    nmpz_number_of_games = 0
-    nmpz_number_of_rounds = 0
-    
-    for i, token in enumerate(game_tokens[:number_of_games]):
-        try:
-            game = session.get(f"{BASE_URL_V3}/games/{token}").json() 
-            
-            if not game['forbidMoving'] and not game['forbidZooming'] and not game['forbidRotating']: # moving
-                mov_number_of_games += 1
-                mov_total_score += float(game['player']['totalScore']['amount'])
-                mov_total_time_sec += float(game['player']['totalTime'])
-                for actual, guess in zip(game['rounds'], game['player']['guesses']):
-                    mov_number_of_rounds += 1
-                    mov_round_wise_time.append(guess['time'])
-                    mov_round_wise_points.append(int(guess['roundScore']['amount'])) 
-                    
-                    country_code = actual['streakLocationCode']
-                    round_score = float(guess['roundScoreInPoints'])
-                    round_distance_km = float(guess['distance']['meters']['amount'])
-                    mov_total_distance_km += round_distance_km
-                    mov_guessed_locations.append({'lat': guess['lat'],
-                                                  'lng': guess['lng'],
-                                                  'score': guess['roundScoreInPoints']})
-                    
-                    if country_code not in mov_points_lost_per_country:
-                        mov_points_lost_per_country[country_code] = int(5000 - round_score)
-                        mov_distance_per_country[country_code] = int(round_distance_km)
-                        mov_countries[country_code] = 1
-                    else:
-                        mov_points_lost_per_country[country_code] += int(5000 - round_score)
-                        mov_distance_per_country[country_code] += int(round_distance_km)
-                        mov_countries[country_code] += 1
-                        
-            elif game['forbidMoving'] and not game['forbidZooming'] and not game['forbidRotating']: # no-moving
-                no_mov_number_of_games += 1
-                no_mov_total_score += float(game['player']['totalScore']['amount'])
-                no_mov_total_time_sec += float(game['player']['totalTime'])
-                for actual, guess in zip(game['rounds'], game['player']['guesses']):
-                    no_mov_number_of_rounds += 1
-                    no_mov_round_wise_time.append(guess['time'])
-                    no_mov_round_wise_points.append(int(guess['roundScore']['amount'])) 
-                    
-                    country_code = actual['streakLocationCode']
-                    round_score = float(guess['roundScoreInPoints'])
-                    round_distance_km = float(guess['distance']['meters']['amount'])
-                    no_mov_total_distance_km += round_distance_km
-                    no_mov_guessed_locations.append({'lat': guess['lat'],
-                                                     'lng': guess['lng'],
-                                                     'score': guess['roundScoreInPoints']})
-                    
-                    if country_code not in no_mov_points_lost_per_country:
-                        no_mov_points_lost_per_country[country_code] = int(5000 - round_score)
-                        no_mov_distance_per_country[country_code] = int(round_distance_km)
-                        no_mov_countries[country_code] = 1
-                    else:
-                        no_mov_points_lost_per_country[country_code] += int(5000 - round_score)
-                        no_mov_distance_per_country[country_code] += int(round_distance_km)
-                        no_mov_countries[country_code] += 1
-                        
-            elif game['forbidMoving'] and game['forbidZooming'] and game['forbidRotating']: # nmpz
-                
-                nmpz_number_of_games += 1
-                nmpz_total_score += float(game['player']['totalScore']['amount'])
-                nmpz_total_time_sec += float(game['player']['totalTime'])
-                for actual, guess in zip(game['rounds'], game['player']['guesses']):
-                    nmpz_number_of_rounds += 1
-                    nmpz_round_wise_time.append(guess['time'])
-                    nmpz_round_wise_points.append(int(guess['roundScore']['amount'])) 
-                    
-                    country_code = actual['streakLocationCode']
-                    round_score = float(guess['roundScoreInPoints'])
-                    round_distance_km = float(guess['distance']['meters']['amount'])
-                    nmpz_total_distance_km += round_distance_km
-                    nmpz_guessed_locations.append({'lat': guess['lat'],
-                                                   'lng': guess['lng'],
-                                                   'score': guess['roundScoreInPoints']})
-                    
-                    if country_code not in no_mov_points_lost_per_country:
-                        nmpz_points_lost_per_country[country_code] = int(5000 - round_score)
-                        nmpz_distance_per_country[country_code] = int(round_distance_km)
-                        nmpz_countries[country_code] = 1
+def get_game(session, token):
+    with metrics.timer('game_request'):
+        response = session.get(f"{BASE_URL_V3}/games/{token}", timeout=REQUEST_TIMEOUT_SEC)
+        response.raise_for_status()
+    metrics.increment('game_requests')
+    metrics.increment('bytes_received', len(response.content))
+    with metrics.timer('game_decode'):
+        return compact_game(json_loads(response.content))
+
+def compact_game(game):
+    # keeps only the fields get_game_rounds and is_finished read, in the same layout, so
+    # a game is a fraction of its size in memory and in the game store
+    return {'token': game['token'],
+            'state': game.get('state'),
+            'forbidMoving': game['forbidMoving'],
+            'forbidZooming': game['forbidZooming'],
+            'forbidRotating': game['forbidRotating'],
+            'rounds': [{'lat': actual['lat'],
+                        'lng': actual['lng'],
+                        'streakLocationCode': actual['streakLocationCode']}
+                       for actual in game['rounds']],
+            'player': {'guesses': [{'roundScoreInPoints': guess['roundScoreInPoints'],
+                                    'distance': {'meters': {'amount': guess['distance']['meters']['amount']}},
+                                    'time': guess['time'],
+                                    'lat': guess['lat'],
+                                    'lng': guess['lng']}
+                                   for guess in game['player']['guesses']]}}
+
+def iter_games(session, token_pages, number_of_games, progress_bar, max_workers=MAX_WORKERS, game_store=None,
+               dropped_games=None, scheduler=None, budget=None):
+    # yields (index, game) pairs as games arrive, index is the game's position in the feed.
+    # token_pages is an iterable of token lists such as iter_game_tokens(session), the games
+    # of each page are fetched while the following page is still loading. Games that could not
+    # be fetched are counted per reason in dropped_games.
+    # Games are fetched by max_workers threads of this call, or, when a shared
+    # fetch_scheduler.FetchScheduler is given, queued there under this session.
+    # With an AnalysisBudget, no more games are requested once it is over
+    game_tokens = []
+    futures = {}
+    finished_games = {}
+    completed = 0
+    if number_of_games <= 0:
+        return
+
+    # progress is reported from this thread, streamlit elements can't be updated from the workers
+    def report_progress():
+        percent_complete = int(completed * 100 / number_of_games)
+        progress_bar.progress(percent_complete, f'Analyzing... ({percent_complete}%)')
+
+    def collect(done_futures):
+        nonlocal completed
+        for future in done_futures:
+            i = futures.pop(future)
+            completed += 1
+            report_progress()
+            try:
+                game = future.result()
+            except Exception as e:
+                drop_game(dropped_games, get_drop_reason(e))
+                continue
+            if game_store and is_finished(game):
+                finished_games[game_tokens[i]] = game
+            yield i, game
+
+    def collect_rest():
+        if budget is None:
+            yield from collect(as_completed(list(futures)))
+            return
+        pending = set(futures)
+        while pending and not budget.is_over():
+            done, pending = wait(pending, timeout=budget.get_wait_timeout(), return_when=FIRST_COMPLETED)
+            yield from collect(done)
+            # also gives streamlit a chance to stop this run when the session reruns or ends
+            report_progress()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers) if scheduler is None else None
+    try:
+        for page_tokens in token_pages:
+            if budget is not None and budget.is_over():
+                break
+            page_tokens = page_tokens[:number_of_games - len(game_tokens)]
+            with metrics.timer('cache_read'):
+                cached_games = game_store.get_many(page_tokens) if game_store else {}
+            metrics.increment('cache_hits', len(cached_games))
+            metrics.increment('cache_misses', len(page_tokens) - len(cached_games))
+            for token in page_tokens:
+                game_tokens.append(token)
+                if token in cached_games:
+                    completed += 1
+                    yield len(game_tokens) - 1, cached_games[token]
+                else:
+                    if scheduler is None:
+                        future = metrics.submit(executor, get_game, session, token)
                     else:
-                        nmpz_points_lost_per_country[country_code] += int(5000 - round_score)
-                        nmpz_distance_per_country[country_code] += int(round_distance_km)
-                        nmpz_countries[country_code] += 1
-                        
-        except Exception as e:
+                        future = scheduler.submit(id(session), get_game, session, token)
+                    futures[future] = len(game_tokens) - 1
+            report_progress()
+            yield from collect([future for future in futures if future.done()])
+            if len(game_tokens) >= number_of_games:
+                break
+        yield from collect_rest()
+    finally:
+        # also reached when the caller stops early, games fetched so far are kept.
+        # Requests that are already running finish in the background and are not waited for
+        for future in futures:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False)
+        if game_store:
+            with metrics.timer('cache_write'):
+                game_store.put_many(finished_games)
+
+def get_games(session, token_pages, number_of_games, progress_bar, max_workers=MAX_WORKERS, game_store=None,
+              dropped_games=None, scheduler=None, budget=None):
+    games = dict(iter_games(session, token_pages, number_of_games, progress_bar, max_workers, game_store, dropped_games,
+                            scheduler, budget))
+    return [games[i] for i in sorted(games)]
+
+def get_game_mode(game):
+    if not game['forbidMoving'] and not game['forbidZooming'] and not game['forbidRotating']:
+        return 'moving'
+    elif game['forbidMoving'] and not game['forbidZooming'] and not game['forbidRotating']:
+        return 'no-moving'
+    elif game['forbidMoving'] and game['forbidZooming'] and game['forbidRotating']:
+        return 'nmpz'
+    return None
+
+def get_game_rounds(game):
+    mode = get_game_mode(game)
+    if mode is None:
+        return []
+    return [(mode,
+             game['token'],
+             round_index,
+             actual['streakLocationCode'] or '',
+             int(guess['roundScoreInPoints']),
+             float(guess['distance']['meters']['amount']),
+             float(guess['time']),
+             float(guess['lat']),
+             float(guess['lng']),
+             float(actual['lat']),
+             float(actual['lng']))
+            for round_index, (actual, guess) in enumerate(zip(game['rounds'], game['player']['guesses']))]
+
+def parse_game_rounds(game, dropped_games=None):
+    try:
+        with metrics.timer('parse_rounds'):
+            return get_game_rounds(game)
+    except Exception as e:
+        drop_game(dropped_games, 'unparsable')
+        return []
+
+def add_to(totals, key, value):
+    totals[key] = totals.get(key, 0) + value
+
+def get_round_columns(rows):
+    # the columns of rows as arrays, with the country and the offsets of every guess. Categorical
+    # columns are object arrays until make_guess_table. Rows that go on with the GUESS_COLUMNS, like
+    # those of a saved round table, keep theirs instead of looking them up again
+    import numpy as np
+    columns = dict(zip(ROUND_COLUMNS + GUESS_COLUMNS, zip(*rows))) if rows else dict.fromkeys(ROUND_COLUMNS, ())
+    columns = {column: np.array(values, dtype=object if column in CATEGORY_COLUMNS + ['mode'] else ROUND_DTYPES.get(column, float))
+               for column, values in columns.items()}
+    if 'guess_country' not in columns:
+        columns['guess_country'] = np.asarray(get_guess_countries(columns['guess_lat'], columns['guess_lng']), dtype=object)
+        offsets = get_guess_offsets(columns['actual_lat'], columns['actual_lng'], columns['guess_lat'], columns['guess_lng'])
+        columns.update(zip(OFFSET_COLUMNS, offsets))
+    return columns
+
+def get_codes(categories, values):
+    # codes of values in categories, a {value: code} dict that new values are added to
+    import numpy as np
+    return np.array([categories.setdefault(value, len(categories)) for value in values], dtype=np.int32)
+
+@metrics.timed('build_round_table')
+def make_guess_table(mode, columns, categories):
+    # the round table of to_stats from the columns of a mode, see StatsAccumulator.get_mode_columns
+    import numpy as np
+    import pandas as pd
+    round_table = {}
+    for column in ROUND_COLUMNS + GUESS_COLUMNS:
+        if column == 'mode':
+            round_table[column] = pd.Categorical.from_codes(np.full(len(columns['position']), MODES.index(mode)),
+                                                            dtype=pd.CategoricalDtype(MODES))
+        elif column in CATEGORY_COLUMNS:
+            # with the categories sorted, as astype('category') has them
+            round_table[column] = (pd.Categorical.from_codes(columns[column], categories=list(categories[column]))
+                                   .reorder_categories(sorted(categories[column])))
+        else:
+            round_table[column] = columns[column]
+    return pd.DataFrame(round_table)
+
+class StatsAccumulator:
+    # Partial stats of a set of games, to_stats turns them into what get_stats returns.
+    # Accumulators of disjoint sets of games merge into the accumulator of all of them, and
+    # merge is associative, so games can be reduced one by one, per batch or per worker and
+    # combined afterwards. The rows of added games are kept until flush turns them into columns
+    # per mode and adds their guess counts to the totals, so the countries and offsets of the
+    # guesses are worked out once per batch of games. Categorical columns are kept as codes of
+    # categories that only grow, and to_stats joins the columns without looking at the values again
+    def __init__(self):
+        self.modes = {}
+        # rows of the games added since the last flush and the position of the game of each one
+        self.rows = []
+        self.positions = []
+
+    def get_mode_totals(self, mode):
+        return self.modes.setdefault(mode, {'number_of_games': 0,
+                                            'number_of_rounds': 0,
+                                            'total_score': 0,
+                                            'total_distance': 0.0,
+                                            'total_time': 0.0,
+                                            'points_lost_per_country': {},
+                                            'distance_per_country': {},
+                                            'countries': {},
+                                            'points_histogram': [0] * (len(POINTS_BUCKETS) - 1),
+                                            # see add_country_guesses and add_guess_offsets
+                                            'country_guesses': 0,
+                                            'correct_country_guesses': 0,
+                                            'confusions': {},
+                                            'total_north_km': 0.0,
+                                            'total_east_km': 0.0,
+                                            'direction_histogram': [0] * len(DIRECTIONS),
+                                            'offset_per_country': {},
+                                            # columns of the flushed rows, see get_round_columns,
+                                            # with the position of each row and CATEGORY_COLUMNS as
+                                            # codes of categories
+                                            'columns': [],
+                                            'categories': {column: {} for column in CATEGORY_COLUMNS}})
+
+    def add_game(self, game_rounds, position=0):
+        # game_rounds are the rows of one game, see get_game_rounds. to_stats puts the rounds in the
+        # order of position, those of games with the same position in the order they were added
+        if not game_rounds:
+            return self
+        totals = self.get_mode_totals(game_rounds[0][0])
+        totals['number_of_games'] += 1
+        for row in game_rounds:
+            country, score, distance, time = row[3:7]
+            totals['number_of_rounds'] += 1
+            totals['total_score'] += score
+            totals['total_distance'] += distance
+            totals['total_time'] += time
+            # per-round values are truncated before they are summed per country
+            add_to(totals['points_lost_per_country'], country, 5000 - score)
+            add_to(totals['distance_per_country'], country, int(distance))
+            add_to(totals['countries'], country, 1)
+            # like numpy.histogram the last bucket includes its upper bound
+            if POINTS_BUCKETS[0] <= score <= POINTS_BUCKETS[-1]:
+                totals['points_histogram'][min(int(score) // 1000, len(POINTS_BUCKETS) - 2)] += 1
+        self.rows.extend(game_rounds)
+        self.positions.extend([position] * len(game_rounds))
+        return self
+
+    def flush(self):
+        import numpy as np
+        if not self.rows:
+            return self
+        columns = get_round_columns(self.rows)
+        columns['position'] = np.array(self.positions)
+        for mode in MODES:
+            in_mode = columns['mode'] == mode
+            if not in_mode.any():
+                continue
+            totals = self.get_mode_totals(mode)
+            mode_columns = {column: values[in_mode] for column, values in columns.items() if column != 'mode'}
+            add_country_guesses(totals, mode_columns)
+            add_guess_offsets(totals, mode_columns)
+            for column in CATEGORY_COLUMNS:
+                mode_columns[column] = get_codes(totals['categories'][column], mode_columns[column])
+            totals['columns'].append(mode_columns)
+        self.rows, self.positions = [], []
+        return self
+
+    def merge(self, other):
+        # adds other to this accumulator and returns it. The rows of both are flushed first
+        self.flush()
+        other.flush()
+        for mode, other_totals in other.modes.items():
+            totals = self.get_mode_totals(mode)
+            for key in ('number_of_games', 'number_of_rounds', 'total_score', 'total_distance', 'total_time',
+                        'country_guesses', 'correct_country_guesses', 'total_north_km', 'total_east_km'):
+                totals[key] += other_totals[key]
+            for key in ('points_lost_per_country', 'distance_per_country', 'countries', 'confusions'):
+                for country, value in other_totals[key].items():
+                    add_to(totals[key], country, value)
+            for key in ('points_histogram', 'direction_histogram'):
+                totals[key] = [count + other_count for count, other_count in zip(totals[key], other_totals[key])]
+            for country, sums in other_totals['offset_per_country'].items():
+                totals['offset_per_country'][country] = [total + value for total, value in
+                                                         zip(totals['offset_per_country'].get(country, [0.0, 0.0, 0]), sums)]
+            # the codes of other are translated into those of this accumulator
+            codes = {column: get_codes(totals['categories'][column], other_totals['categories'][column])
+                     for column in CATEGORY_COLUMNS}
+            totals['columns'].extend(dict(columns, **{column: codes[column][columns[column]] for column in CATEGORY_COLUMNS})
+                                     for columns in other_totals['columns'])
+        return self
+
+    def get_mode_columns(self, mode):
+        # the flushed columns of a mode joined, in the order of the positions of the rows. They are kept
+        # in place of the ones they were joined from, so the next call only joins the rows flushed since
+        import numpy as np
+        totals = self.modes.get(mode)
+        if not totals or not totals['columns']:
+            columns = get_round_columns([])
+            columns['position'] = np.array([], dtype=int)
+            for column in CATEGORY_COLUMNS:
+                columns[column] = get_codes({}, columns[column])
+            return columns
+        if len(totals['columns']) > 1:
+            columns = {column: np.concatenate([batch[column] for batch in totals['columns']])
+                       for column in totals['columns'][0]}
+            if (np.diff(columns['position']) < 0).any():
+                order = np.argsort(columns['position'], kind='stable')
+                columns = {column: values[order] for column, values in columns.items()}
+            totals['columns'] = [columns]
+        return totals['columns'][0]
+
+    @metrics.timed('aggregate')
+    def to_stats(self, round_table=True):
+        # without round_table, 'rounds' is None, e.g. for partial results that are replaced soon
+        import pandas as pd
+        self.flush()
+        stats = {}
+        for mode in MODES:
+            totals = self.modes.get(mode) or StatsAccumulator().get_mode_totals(mode)
+            number_of_games = totals['number_of_games']
+            columns = self.get_mode_columns(mode)
+            # in the order the countries first appear in, as when the games are added in order
+            country_names = list(totals['categories']['country'])
+            countries = [country_names[code] for code in pd.unique(columns['country'])]
+            correct_country_rate, country_confusions = get_country_guess_stats(totals)
+            average_offset, direction_histogram, offset_per_country = get_offset_stats(totals)
+            stats[mode] = {'average_score': int(totals['total_score'] / number_of_games) if number_of_games else 0,
+                           'average_distance': int(totals['total_distance'] / number_of_games) if number_of_games else 0,
+                           'average_time': int(totals['total_time'] / number_of_games) if number_of_games else 0,
+                           'round_wise_points': columns['score'],
+                           'round_wise_time': columns['time'],
+                           'points_lost_per_country': {country: totals['points_lost_per_country'][country] for country in countries},
+                           'distance_per_country': {country: totals['distance_per_country'][country] for country in countries},
+                           'number_of_games': number_of_games,
+                           'number_of_rounds': totals['number_of_rounds'],
+                           'guessed_locations': pd.DataFrame({'lat': columns['guess_lat'], 'lng': columns['guess_lng'],
+                                                              'score': columns['score']}),
+                           'countries': {country: totals['countries'][country] for country in countries},
+                           'points_histogram': list(totals['points_histogram']),
+                           'correct_country_rate': correct_country_rate,
+                           'country_confusions': country_confusions,
+                           'average_offset': average_offset,
+                           'direction_histogram': direction_histogram,
+                           'offset_per_country': offset_per_country,
+                           'rounds': make_guess_table(mode, columns, totals['categories']) if round_table else None}
+        return stats
+
+def add_country_guesses(totals, columns):
+    # counts the rounds guessed in the right country and the (actual, guessed) pairs of the wrong ones.
+    # Rounds in a country that is not in MAPPED_COUNTRY_CODES, or without a country, are left out.
+    # '' as the guess is a guess in no country
+    import numpy as np
+    actual = np.array([country.lower() for country in columns['country']], dtype=object)
+    mapped = np.array([country in MAPPED_COUNTRY_CODES for country in actual], dtype=bool)
+    actual, guessed = actual[mapped], columns['guess_country'][mapped]
+    wrong = actual != guessed
+    totals['country_guesses'] += len(actual)
+    totals['correct_country_guesses'] += int(len(actual) - wrong.sum())
+    for pair in zip(actual[wrong], guessed[wrong]):
+        add_to(totals['confusions'], pair, 1)
+
+def get_country_guess_stats(totals):
+    # share of rounds guessed in the right country, and the most frequent (actual, guessed, rounds) of the
+    # wrong ones, ties in the order of the countries
+    if not totals['country_guesses']:
+        return 0.0, []
+    confusions = heapq.nsmallest(CONFUSION_PAIRS, totals['confusions'].items(), key=lambda item: (-item[1], item[0]))
+    return (totals['correct_country_guesses'] / totals['country_guesses'],
+            [(actual, guessed, rounds) for (actual, guessed), rounds in confusions])
+
+def add_guess_offsets(totals, columns):
+    # sums the (north, east) offsets of the guesses in km, overall and per country, and counts the
+    # guesses per DIRECTIONS sector
+    import numpy as np
+    north, east = columns['north_km'], columns['east_km']
+    totals['total_north_km'] += float(north.sum())
+    totals['total_east_km'] += float(east.sum())
+    sector_width = 360 / len(DIRECTIONS)
+    sectors = ((columns['bearing'] + sector_width / 2) // sector_width).astype(int) % len(DIRECTIONS)
+    totals['direction_histogram'] = [count + int(new_count) for count, new_count in
+                                     zip(totals['direction_histogram'], np.bincount(sectors, minlength=len(DIRECTIONS)))]
+    countries, codes = np.unique(columns['country'], return_inverse=True)
+    rounds = np.bincount(codes, minlength=len(countries))
+    north_sums = np.bincount(codes, weights=north, minlength=len(countries))
+    east_sums = np.bincount(codes, weights=east, minlength=len(countries))
+    for country, country_rounds, north_sum, east_sum in zip(countries, rounds, north_sums, east_sums):
+        if country == '':
             continue
-        finally:
-            percent_complete = int(i * 100 / number_of_games)
-            progress_bar.progress(percent_complete, f'Analyzing... ({percent_complete}%)')
-    
-    return {
-        'moving': {'average_score': int(mov_total_score/mov_number_of_games) if mov_number_of_games else 0,
-                   'average_distance': int(mov_total_distance_km/mov_number_of_games) if mov_number_of_games else 0,
-                   'average_time': int(mov_total_time_sec/mov_number_of_games) if mov_number_of_games else 0,
-                   'round_wise_points': mov_round_wise_points,
-                   'round_wise_time': mov_round_wise_time,
-                   'points_lost_per_country': mov_points_lost_per_country,
-                   'distance_per_country': mov_distance_per_country,
-                   'number_of_games': mov_number_of_games,
-                   'number_of_rounds': mov_number_of_rounds,
-                   'guessed_locations': mov_guessed_locations,
-                   'countries': mov_countries},
-        'no-moving': {'average_score': int(no_mov_total_score/no_mov_number_of_games) if no_mov_number_of_games else 0,
-                      'average_distance': int(no_mov_total_distance_km/no_mov_number_of_games) if no_mov_number_of_games else 0,
-                      'average_time': int(no_mov_total_time_sec/no_mov_number_of_games) if no_mov_number_of_games else 0,
-                      'round_wise_points': no_mov_round_wise_points,
-                      'round_wise_time': no_mov_round_wise_time,
-                      'points_lost_per_country': no_mov_points_lost_per_country,
-                      'distance_per_country': no_mov_distance_per_country,
-                      'number_of_games': no_mov_number_of_games,
-                      'number_of_rounds': no_mov_number_of_rounds,
-                      'guessed_locations': no_mov_guessed_locations,
-                      'countries': no_mov_countries},
-        'nmpz': {'average_score': int(nmpz_total_score/nmpz_number_of_games) if nmpz_number_of_games else 0,
-                 'average_distance': int(nmpz_total_distance_km/nmpz_number_of_games) if nmpz_number_of_games else 0,
-                 'average_time': int(nmpz_total_time_sec/nmpz_number_of_games) if nmpz_number_of_games else 0,
-                 'round_wise_points': nmpz_round_wise_points,
-                 'round_wise_time': nmpz_round_wise_time,
-                 'points_lost_per_country': nmpz_points_lost_per_country,
-                 'distance_per_country': nmpz_distance_per_country,
-                 'number_of_games': nmpz_number_of_games,
-                 'number_of_rounds': nmpz_number_of_rounds,
-                 'guessed_locations': nmpz_guessed_locations,
-                 'countries': nmpz_countries}
-    }  
+        sums = totals['offset_per_country'].get(country, [0.0, 0.0, 0])
+        totals['offset_per_country'][country] = [sums[0] + float(north_sum), sums[1] + float(east_sum),
+                                                 sums[2] + int(country_rounds)]
+
+def get_offset_stats(totals):
+    # mean (north, east) offset of the guesses in km, the number of guesses per DIRECTIONS sector,
+    # and {country: (north, east, rounds)} of the countries with at least MIN_OFFSET_ROUNDS rounds
+    rounds = totals['number_of_rounds']
+    if not rounds:
+        return (0, 0), [0] * len(DIRECTIONS), {}
+    average_offset = (int(totals['total_north_km'] / rounds), int(totals['total_east_km'] / rounds))
+    offset_per_country = {country: (int(north / country_rounds), int(east / country_rounds), country_rounds)
+                          for country, (north, east, country_rounds) in totals['offset_per_country'].items()
+                          if country_rounds >= MIN_OFFSET_ROUNDS}
+    return average_offset, [int(count) for count in totals['direction_histogram']], offset_per_country
+
+def combine(accumulators):
+    return functools.reduce(StatsAccumulator.merge, accumulators, StatsAccumulator())
+
+def accumulate_games(games, dropped_games=None):
+    accumulator = StatsAccumulator()
+    for game in games:
+        if game is not None:
+            accumulator.add_game(parse_game_rounds(game, dropped_games))
+    return accumulator
+
+def accumulate_round_table(round_table):
+    # the other way round from to_stats, e.g. for a saved round table. The rows of a game are next to
+    # each other in it, in feed order within each mode
+    accumulator = StatsAccumulator()
+    # the country and offsets of the guesses are reused when the table has them
+    columns = ROUND_COLUMNS + GUESS_COLUMNS if set(GUESS_COLUMNS) <= set(round_table.columns) else ROUND_COLUMNS
+    rows = zip(*[round_table[column].tolist() for column in columns])
+    for _, game_rounds in itertools.groupby(rows, key=lambda row: row[1]):
+        accumulator.add_game(list(game_rounds))
+    return accumulator
+
+def sample_game_tokens(game_tokens, sample_size, seed=None):
+    # stratified over time: the tokens, newest first, are cut into sample_size runs of consecutive
+    # games and one game is drawn at random from each run. Returned in feed order
+    rng = random.Random(seed)
+    bounds = [len(game_tokens) * i // sample_size for i in range(sample_size + 1)]
+    return [game_tokens[rng.randrange(start, end)] for start, end in zip(bounds, bounds[1:])]
+
+def get_token_pages(game_tokens, number_of_games, sample_size=None):
+    # game_tokens is either a list of tokens or an iterable of token pages, see iter_games.
+    # Returns (token pages, games to analyze, games sampled from or None). With a sample_size below
+    # number_of_games, only a sample of the number_of_games most recent games is analyzed
+    token_pages = [game_tokens] if isinstance(game_tokens, (list, tuple)) else game_tokens
+    if sample_size is None or sample_size >= number_of_games:
+        return token_pages, number_of_games, None
+    tokens = list(itertools.islice(itertools.chain.from_iterable(token_pages), number_of_games))
+    sample = sample_game_tokens(tokens, min(sample_size, len(tokens))) if tokens else []
+    return [sample], len(sample), len(tokens)
+
+def add_sample_estimates(stats, population_games):
+    # for the stats of a random sample of population_games games: the 95% confidence interval (low, high) of
+    # each average of a mode, None below 2 games or without a round table, and the estimated number of games
+    # and rounds of the mode among all of them. The totals per country, the rounds of the confusions and
+    # offsets and the points and direction histograms are scaled up to all games in place, number_of_games
+    # and number_of_rounds stay those of the sample
+    import numpy as np
+    sampled_games = sum(stats[mode]['number_of_games'] for mode in MODES)
+    stats['sample'] = {'sampled_games': sampled_games, 'population_games': population_games}
+    # finite population correction, the interval closes as the sample approaches all games
+    correction = np.sqrt(max(0.0, 1 - sampled_games / population_games)) if population_games else 0.0
+    for mode in MODES:
+        mode_stats = stats[mode]
+        number_of_games = mode_stats['number_of_games']
+        scale = population_games / sampled_games if sampled_games else 0
+        mode_stats['estimated_number_of_games'] = round(number_of_games * scale)
+        mode_stats['estimated_number_of_rounds'] = round(mode_stats['number_of_rounds'] * scale)
+        for key in ('points_lost_per_country', 'distance_per_country', 'countries'):
+            mode_stats[key] = {country: round(value * scale) for country, value in mode_stats[key].items()}
+        for key in ('points_histogram', 'direction_histogram'):
+            mode_stats[key] = [round(count * scale) for count in mode_stats[key]]
+        mode_stats['country_confusions'] = [(actual, guessed, round(rounds * scale))
+                                            for actual, guessed, rounds in mode_stats['country_confusions']]
+        mode_stats['offset_per_country'] = {country: (north, east, round(rounds * scale))
+                                            for country, (north, east, rounds) in mode_stats['offset_per_country'].items()}
+        confidence_intervals = {}
+        if number_of_games >= 2 and mode_stats['rounds'] is not None:
+            per_game = mode_stats['rounds'].groupby('game_token', observed=True)[['score', 'distance', 'time']].sum()
+        for key, column in (('average_score', 'score'), ('average_distance', 'distance'), ('average_time', 'time')):
+            if number_of_games < 2 or mode_stats['rounds'] is None:
+                confidence_intervals[key] = None
+                continue
+            mean = per_game[column].mean()
+            half_width = CONFIDENCE_Z * per_game[column].std() / np.sqrt(number_of_games) * correction
+            confidence_intervals[key] = (int(mean - half_width), int(mean + half_width))
+        mode_stats['confidence_intervals'] = confidence_intervals
+    return stats
+
+def get_stats(session, game_tokens, number_of_games, progress_bar, max_workers=MAX_WORKERS, game_store=None,
+              scheduler=None, budget=None, sample_size=None):
+    # game_tokens is either a list of tokens or an iterable of token pages, see iter_games.
+    # With a sample_size the stats are estimated from that many games, see get_token_pages
+    token_pages, number_of_games, population_games = get_token_pages(game_tokens, number_of_games, sample_size)
+    dropped_games = {}
+    games = get_games(session, token_pages, number_of_games, progress_bar, max_workers, game_store, dropped_games,
+                      scheduler, budget)
+    stats = accumulate_games(games, dropped_games).to_stats()
+    # number of games left out of the stats per reason, e.g. {'rate_limited': 2}
+    stats['dropped_games'] = dropped_games
+    # None, or why the budget ended the analysis before number_of_games were analyzed
+    stats['stop_reason'] = budget.stop_reason if budget else None
+    # None, or the sizes of the sample and of what it was drawn from, see add_sample_estimates
+    stats['sample'] = None
+    return add_sample_estimates(stats, population_games) if population_games else stats
+
+def iter_stats(session, game_tokens, number_of_games, progress_bar, batch_size=STREAM_BATCH_SIZE,
+               max_workers=MAX_WORKERS, game_store=None, scheduler=None, budget=None, sample_size=None):
+    # yields the stats of all games received so far after every batch_size games,
+    # the last value yielded is the same as what get_stats returns. The round table is only
+    # built for the last one, 'rounds' of the others is None
+    token_pages, number_of_games, population_games = get_token_pages(game_tokens, number_of_games, sample_size)
+    # games arrive out of order, each is added with its position in the feed and to_stats puts the
+    # rounds back in feed order. Every partial result flushes only the games received since the last one
+    accumulator = StatsAccumulator()
+    received = 0
+    dropped_games = {}
+    yielded_state = None
+
+    def get_state():
+        return received, sum(dropped_games.values()), budget.stop_reason if budget else None
+
+    def summarize(round_table):
+        stats = accumulator.to_stats(round_table)
+        stats['dropped_games'] = dict(dropped_games)
+        stats['stop_reason'] = budget.stop_reason if budget else None
+        stats['sample'] = None
+        return add_sample_estimates(stats, population_games) if population_games else stats
+
+    for i, game in iter_games(session, token_pages, number_of_games, progress_bar, max_workers, game_store,
+                              dropped_games, scheduler, budget):
+        accumulator.add_game(parse_game_rounds(game, dropped_games), i)
+        received += 1
+        if received % batch_size == 0:
+            # when every game has arrived this is the last result
+            last = received == number_of_games
+            yielded_state = get_state() if last else None
+            yield summarize(last)
+    if yielded_state != get_state():
+        yield summarize(True)
+
+@functools.lru_cache(maxsize=None)
+def get_country_code_dtype():
+    import pandas as pd
+    return pd.CategoricalDtype(list(country_codes))
+
+def get_country_names(codes):
+    # names of a column of country codes in one categorical lookup, missing for codes that are not
+    # in country_codes, e.g. '' for rounds without a country
+    import pandas as pd
+    codes = pd.Categorical(pd.Series(codes, dtype=object).fillna('').str.lower(), dtype=get_country_code_dtype())
+    return codes.rename_categories(list(country_codes.values()))
 
 def country_code_to_name(df):
-    def get_country_name(code):
-        try:
-            return country_codes[code.lower()]
-        except Exception as e:
-            print(e)
-            return None
-    df['Country'] = df['Country'].apply(lambda x:get_country_name(x))
+    df['Country'] = get_country_names(df['Country'])
     return df
 
-def plot_points_vs_time(stats):
-    fig, ax = plt.subplots()
+def get_top_and_bottom(values, k):
+    # the k largest and the k smallest items of a {key: value} dict, both largest first and ties in dict order,
+    # i.e. the start and the end of sorted(values.items(), key=value, reverse=True). One pass keeps k items in
+    # each of two heaps instead of sorting all of them
+    largest, smallest = [], []
+    if k <= 0:
+        return [], []
+    for order, (key, value) in enumerate(values.items()):
+        for heap, item in ((largest, (value, -order, key)), (smallest, (-value, order, key))):
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+    return ([(key, value) for value, _, key in sorted(largest, reverse=True)],
+            [(key, -value) for value, _, key in sorted(smallest)])
+
+def new_figure(**kwargs):
+    # figures are made with the object-oriented API and never registered with pyplot, whose global list
+    # keeps every figure until it is closed. These are freed like any other object once unreferenced
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+@metrics.timed('render_points_vs_time')
+def plot_points_vs_time(stats, density_threshold=DENSITY_THRESHOLD):
+    fig = new_figure()
+    ax = fig.subplots()
     y_ticks = [0, 1000, 2000, 3000, 4000, 5000]
-    times = []
-    points = []
-    for time, point in zip(stats['round_wise_time'], stats['round_wise_points']):
-        if time < 150:
-            times.append(time)
-            points.append(point)
-            
-    ax.scatter(times, points, marker='.', color='b')
+    times = stats['round_wise_time']
+    points = stats['round_wise_points']
+    times, points = times[times < 150], points[times < 150]
+    
+    if len(times) > density_threshold:
+        hexbin = ax.hexbin(times, points, gridsize=(30, 20), extent=(0, 150, 0, 5000), bins='log', mincnt=1,
+                           cmap='Blues')
+        fig.colorbar(hexbin, ax=ax, label='Rounds')
+    else:
+        ax.scatter(times, points, marker='.', color='b')
     ax.set_yticks(y_ticks)
     ax.set_xlabel('Round Time (s)')
     ax.set_ylabel('Points')
@@ -480,7 +1302,9 @@ def plot_points_vs_time(stats):
     ax.grid(True, which='both', linestyle='--', linewidth=0.5)
     return fig
 
+@metrics.timed('tables')
 def get_most_and_least_data(stats, type):
+    import pandas as pd
     key_mapping = {'points': {'stat_name': 'points_lost_per_country',
                               'col_name': ['Country', 'Points Lost']},
                    'distance': {'stat_name': 'distance_per_country',
@@ -489,9 +1313,8 @@ def get_most_and_least_data(stats, type):
     stat_name = key_mapping[type]['stat_name']
     col_name = key_mapping[type]['col_name']
     
-    top_n = 5 if len(stats) > 5 else len(stats)
-    desc_per_country = sorted(stats[stat_name].items(), key=lambda x: x[1], reverse=True)[:top_n]
-    asc_per_country = sorted(stats[stat_name].items(), key=lambda x: x[1], reverse=True)[-top_n:]
+    # up to 5 countries at each end, both with the most first
+    desc_per_country, asc_per_country = get_top_and_bottom(stats[stat_name], 5)
 
     least_per_country = pd.DataFrame(asc_per_country, columns=col_name)
     most_per_country = pd.DataFrame(desc_per_country, columns=col_name)
@@ -501,16 +1324,52 @@ def get_most_and_least_data(stats, type):
     
     return most_per_country, least_per_country
 
-def points_histogram(stats):
+@metrics.timed('tables')
+def get_confusion_table(stats):
+    import pandas as pd
+    confusions = pd.DataFrame(stats['country_confusions'], columns=['Country', 'Guessed Country', 'Rounds'])
+    confusions['Country'] = get_country_names(confusions['Country'])
+    # every guessed code is in country_codes, '' is a guess in no country
+    confusions['Guessed Country'] = get_country_names(confusions['Guessed Country']).add_categories('No country').fillna('No country')
+    return confusions
 
-    buckets = [0, 1000, 2000, 3000, 4000, 5000]
+@metrics.timed('tables')
+def get_offset_table(stats):
+    # the countries guessed furthest off on average, in one direction
+    import pandas as pd
+    offset_per_country = stats['offset_per_country']
+    furthest, _ = get_top_and_bottom({country: north ** 2 + east ** 2
+                                      for country, (north, east, _) in offset_per_country.items()}, 5)
+    offset_table = pd.DataFrame([(country, format_offset(*offset_per_country[country][:2]), offset_per_country[country][2])
+                                 for country, _ in furthest],
+                                columns=['Country', 'Average Offset', 'Rounds'])
+    return country_code_to_name(offset_table)
+
+@metrics.timed('render_guess_directions')
+def plot_guess_directions(stats):
+    import numpy as np
+    counts = stats['direction_histogram']
+    angles = np.radians(np.arange(len(DIRECTIONS)) * 360 / len(DIRECTIONS))
+    fig = new_figure()
+    ax = fig.subplots(subplot_kw={'projection': 'polar'})
+    ax.set_theta_zero_location('N')
+    ax.set_theta_direction(-1)
+    ax.bar(angles, counts, width=2 * np.pi / len(DIRECTIONS) * 0.9)
+    ax.set_xticks(angles, labels=DIRECTIONS)
+    ax.set_title('Direction of the guess from the location')
+    return fig
+
+@metrics.timed('render_points_histogram')
+def points_histogram(stats):
+    buckets = POINTS_BUCKETS
     x_tick_labels = ['0-1000', '1000-2000', '2000-3000', '3000-4000', '4000-5000']
 
-    # Count the points falling into each bucket
-    counts, _ = np.histogram(stats['round_wise_points'], bins=buckets)
+    # Count of the points falling into each bucket, see StatsAccumulator
+    counts = stats['points_histogram']
 
     # Plot the histogram
-    fig, ax = plt.subplots()
+    fig = new_figure()
+    ax = fig.subplots()
     ax.bar(buckets[:-1], counts, width=1000)
 
     # Customize the plot (optional)
@@ -522,15 +1381,15 @@ def points_histogram(stats):
     
     return fig
 
+@metrics.timed('render_countries_bar_chart')
 def plot_countries_bar_chart(stats):
+    most_frequent, _ = get_top_and_bottom({code: count for code, count in stats['countries'].items()
+                                           if code.lower() in country_codes}, 10)
+    names = get_country_names([code for code, _ in most_frequent])
+    sorted_data = dict(zip(names, [count for _, count in most_frequent]))
 
-    top_n = 10 if len(stats['countries']) > 10 else len(stats['countries'])
-
-    new_stats = {country_codes[key.lower()]: value for key, value in stats['countries'].items() if key}
-    
-    sorted_data = dict(sorted(new_stats.items(), key=lambda item: item[1], reverse=True)[:top_n])
-
-    fig, ax = plt.subplots()
+    fig = new_figure()
+    ax = fig.subplots()
     
     ax.bar(sorted_data.keys(), sorted_data.values())
     ax.set_xlabel('Country')
@@ -540,32 +1399,158 @@ def plot_countries_bar_chart(stats):
     
     return fig
 
-def plot_guessed_locations(guessed_locations):
-    guessed_lat = []
-    guessed_lng = []
-    round_scores = []
-    
-    for guessed_loc in guessed_locations:
-        guessed_lat.append(guessed_loc['lat'])
-        guessed_lng.append(guessed_loc['lng'])
-        round_scores.append(guessed_loc['score'])
-        
-    guessed_df = pd.DataFrame({'lat': guessed_lat,
-                               'lng': guessed_lng,
-                               'score': round_scores})
+@functools.lru_cache(maxsize=None)
+def get_world():
+    import geopandas as gpd
+    return gpd.read_file(WORLD_PATH)
+
+@metrics.timed('geodesic')
+def get_guess_offsets(actual_lat, actual_lng, guess_lat, guess_lng):
+    # for all rounds at once: great-circle distance in km, initial bearing from the actual location to the
+    # guess in degrees clockwise from north, and how far the guess is north and east of the actual location in km
+    import numpy as np
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(degrees, dtype='float64'))
+                              for degrees in (actual_lat, actual_lng, guess_lat, guess_lng))
+    d_lat = lat2 - lat1
+    # the short way round, across the antimeridian if need be
+    d_lng = (lng2 - lng1 + np.pi) % (2 * np.pi) - np.pi
+    haversine = np.sin(d_lat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lng / 2) ** 2
+    distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+    bearing = np.degrees(np.arctan2(np.sin(d_lng) * np.cos(lat2),
+                                    np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(d_lng))) % 360
+    north = EARTH_RADIUS_KM * d_lat
+    east = EARTH_RADIUS_KM * d_lng * np.cos((lat1 + lat2) / 2)
+    return distance, bearing, north, east
+
+def format_offset(north, east):
+    # e.g. '120 KM N, 40 KM W'
+    return f"{abs(north)} KM {'N' if north >= 0 else 'S'}, {abs(east)} KM {'E' if east >= 0 else 'W'}"
+
+@functools.lru_cache(maxsize=None)
+def get_country_shapes():
+    # the countries of get_world with the codes of country_codes and their spatial index, built once per process
+    world = get_world()
+    shapes = world.assign(country=world['iso_a3'].map(iso_a3_codes))[['country', 'geometry']].reset_index(drop=True)
+    shapes.sindex
+    return shapes
+
+@functools.lru_cache(maxsize=None)
+def get_coast_shapes():
+    # the same countries grown by COAST_TOLERANCE_DEG, in the same order
+    with warnings.catch_warnings():
+        # buffering in degrees is the point here, the tolerance is for the map's coarse outlines in lng/lat
+        # and not a distance, so geopandas' warning about buffering in a geographic CRS doesn't apply
+        warnings.filterwarnings('ignore', 'Geometry is in a geographic CRS', UserWarning)
+        coasts = get_country_shapes().buffer(COAST_TOLERANCE_DEG, resolution=4)
+    coasts.sindex
+    return coasts
+
+@metrics.timed('reverse_geocode')
+def get_guess_countries(lat, lng):
+    # country code of every guess, '' for guesses in the sea. All guesses are looked up in one query
+    # of the spatial index instead of one point at a time, the ones outside every country in a second
+    import numpy as np
+    import pandas as pd
+    import geopandas as gpd
+    countries = np.full(len(lat), '', dtype=object)
+    if len(lat):
+        shapes = get_country_shapes()
+        points = gpd.points_from_xy(lng, lat, crs=shapes.crs)
+        point_index, shape_index = shapes.sindex.query(points, predicate='within')
+        countries[point_index] = shapes['country'].to_numpy()[shape_index]
+        outside = np.flatnonzero(countries == '')
+        point_index, shape_index = get_coast_shapes().sindex.query(points[outside], predicate='within')
+        # the buffered shapes of neighbouring countries overlap, a point within several of them is placed
+        # in the country whose own shape is nearest. Like the buffer, the distance is in degrees
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', 'Geometry is in a geographic CRS', UserWarning)
+            distances = shapes.geometry.values[shape_index].distance(points[outside][point_index])
+        order = np.lexsort((distances, point_index))
+        point_index, shape_index = point_index[order], shape_index[order]
+        nearest = np.unique(point_index, return_index=True)[1]
+        countries[outside[point_index[nearest]]] = shapes['country'].to_numpy()[shape_index[nearest]]
+    return pd.Categorical(countries)
+
+@functools.lru_cache(maxsize=None)
+def get_basemap():
+    import numpy as np
+    import matplotlib.pyplot as plt
+    # the world layer is rasterized once per process and reused by every map as an image
+    fig = new_figure(figsize=(20, 10), dpi=100)
+    ax = fig.add_axes([0, 0, 1, 1])
+    open_figures = set(plt.get_fignums())
+    get_world().plot(ax=ax, color='lightblue')
+    # GeoDataFrame.plot ends with plt.draw(), which opens an empty pyplot figure when there is none
+    for number in set(plt.get_fignums()) - open_figures:
+        plt.close(number)
+    ax.set_xlim(WORLD_EXTENT[:2])
+    ax.set_ylim(WORLD_EXTENT[2:])
+    ax.set_aspect('auto')
+    ax.set_axis_off()
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba()).copy()
+
+@metrics.timed('render_guessed_locations')
+def plot_guessed_locations(guessed_locations, density_threshold=DENSITY_THRESHOLD):
+    if len(guessed_locations) > density_threshold:
+        return plot_guess_density(guessed_locations)
     
-    world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+    fig = new_figure(figsize=(10,10))
+    ax = fig.subplots()
+    ax.imshow(get_basemap(), extent=WORLD_EXTENT)
 
-    guessed_geometry = [Point(xy) for xy in zip(guessed_df['lng'], guessed_df['lat'])]
-    guessed_gdf = GeoDataFrame(guessed_df, geometry=guessed_geometry)
-    ax = guessed_gdf.plot(ax=world.plot(figsize=(10,10), color='lightblue'), marker='o', markersize=3,
-                    cax='score', cmap='YlOrRd', vmin=0, vmax=5000)
+    # the same markers GeoDataFrame.plot draws for points, without its plt.draw()
+    points = ax.scatter(guessed_locations['lng'], guessed_locations['lat'], c=guessed_locations['score'], s=3,
+                        marker='o', cmap='YlOrRd', vmin=0, vmax=5000)
     
     ax.set_title('Guessed Locations')
     ax.set_axis_off()
-    fig = ax.get_figure()
     cax = fig.add_axes([0.1, 0.26, 0.8, 0.03])
-    sm = plt.cm.ScalarMappable(cmap='YlOrRd', norm=plt.Normalize(vmin=0, vmax=5000))
-    sm._A = []
-    fig.colorbar(sm, cax=cax, orientation='horizontal', label='Score')
-    return fig
\ No newline at end of file
+    fig.colorbar(points, cax=cax, orientation='horizontal', label='Score')
+    return fig
+
+def plot_guess_density(guessed_locations):
+    # number of guesses per hexagon of about 4 degrees, drawn over the same basemap
+    fig = new_figure(figsize=(10,10))
+    ax = fig.subplots()
+    ax.imshow(get_basemap(), extent=WORLD_EXTENT)
+    hexbin = ax.hexbin(guessed_locations['lng'], guessed_locations['lat'], gridsize=(90, 30), extent=WORLD_EXTENT,
+                       bins='log', mincnt=1, cmap='YlOrRd', alpha=0.8)
+
+    ax.set_title('Guessed Locations')
+    ax.set_axis_off()
+    cax = fig.add_axes([0.1, 0.26, 0.8, 0.03])
+    fig.colorbar(hexbin, cax=cax, orientation='horizontal', label='Guesses')
+    return fig
+
+def render_figure(name, stats):
+    # draws one of FIGURE_STATS headless and returns it as PNG bytes, it runs in the worker processes
+    # of render_figures so only the stats it needs are passed in
+    plots = {'countries_bar_chart': plot_countries_bar_chart,
+             'points_vs_time': plot_points_vs_time,
+             'points_histogram': points_histogram,
+             'guess_directions': plot_guess_directions,
+             'guessed_locations': lambda stats: plot_guessed_locations(stats['guessed_locations'])}
+    fig = plots[name](stats)
+    buffer = io.BytesIO()
+    # same output as st.pyplot
+    fig.savefig(buffer, format='png', dpi=200, bbox_inches='tight')
+    # the artists of a figure refer to each other, clearing it frees them now rather than at the next
+    # garbage collection
+    fig.clear()
+    return buffer.getvalue()
+
+def warm_up_figure_worker():
+    # loads matplotlib and the basemap before the first figure is requested
+    import matplotlib
+    matplotlib.use('Agg')
+    get_basemap()
+
+@metrics.timed('render_figures')
+def render_figures(stats, executor=None):
+    # PNG bytes of every figure of a mode, drawn in parallel when executor is a process pool
+    names = list(FIGURE_STATS)
+    figure_stats = [{key: stats[key] for key in FIGURE_STATS[name]} for name in names]
+    if executor is None:
+        return list(map(render_figure, names, figure_stats))
+    return list(executor.map(render_figure, names, figure_stats))